@@ -1,51 +1,212 @@
+import io
 import os
-from flask import Flask, request, abort, jsonify
+import threading
+from flask import Flask, request, abort, Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Actor, Movie, db
-from auth.auth import AuthError, requires_auth
-from flask_migrate import Migrate
+from sqlalchemy.orm import selectinload
+from models import setup_db, Actor, Movie, db, cast, add_cast, \
+    remove_cast, update_row, delete_row
+from auth.auth import AuthError, requires_auth, check_permissions
+from pagination import paginate
+from filters import apply_filters, sort_keys
+from search import search, search_terms
+from fields import requested_fields, project, only, get_formatted
+from serialization import JSONEncoder, jsonify
+from validation import ValidationError, actor_fields, movie_fields
+from bulk import NO_FIELDS, bulk_create, bulk_patch, bulk_remove
+from export import export_response
+from http_cache import conditional, versioned
+from replicas import read_replica
+from response_cache import cached
+from importer import RESOURCES, FORMATS, IMPORT_CHUNK_SIZE, read_rows, \
+    import_rows
+import metrics
+import instrumentation
+import rate_limit
+import compression
+from profiler import profiler
+from stats import read_stats
 
-RESULTS_PER_PAGE = 10
 
+def page_response(name, page):
+    response = {
+        'success': True,
+        name: page['items'],
+        'next': page['next'],
+        'prev': page['prev']
+    }
+    if 'total' in page:
+        response['total'] = page['total']
+    return response
 
-def paginate_results(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * RESULTS_PER_PAGE
-    end = start + RESULTS_PER_PAGE
 
-    results = [result.format() for result in selection]
-    current_result = results[start:end]
-    return current_result
+def includes(request, name):
+    return name in request.args.get('include', '').split(',')
+
+
+def format_actor_with_cast(actor):
+    return dict(actor.format(),
+                movies=[movie.format() for movie in actor.movies])
+
+
+def format_movie_with_cast(movie):
+    return dict(movie.format(),
+                cast=[actor.format() for actor in movie.actors])
+
+
+def exists(model, id):
+    return db.session.query(
+        db.session.query(model.id).filter(model.id == id).exists()).scalar()
+
+
+def if_match(request):
+    """Returns the row versions listed in If-Match, or None when any
+    version will do. The ETags are the quoted versions GET /actors/<id>
+    and GET /movies/<id> send, e.g. "3".
+    """
+    value = request.headers.get('If-Match')
+    if value is None or value.strip() == '*':
+        return None
+    versions = []
+    for tag in value.split(','):
+        tag = tag.strip()
+        # weak tags never match (RFC 7232, section 3.1)
+        if not (tag.startswith('"') and tag.endswith('"')):
+            continue
+        # compressed responses carry "<version>-<encoding>"
+        version = tag[1:-1].split('-', 1)[0]
+        if version.isdigit():
+            versions.append(int(version))
+    if not versions:
+        abort(412)
+    return versions
+
+
+def write_failed(model, id, versions):
+    """Aborts a PATCH or DELETE that matched no row: 412 when the row
+    exists at another version, 404 otherwise.
+    """
+    if versions is not None and exists(model, id):
+        abort(412)
+    abort(404)
+
+
+def search_page(request, model):
+    query, keys = search(model, search_terms(request))
+    query = apply_filters(request, model, query)
+    formatter = None
+    fields = requested_fields(request, model)
+    if fields:
+        query, formatter = project(query, model, fields)
+    return paginate(request, query, keys, formatter)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json_encoder = JSONEncoder
+    instrumentation.init_app(app)
+    rate_limit.init_app(app)
+    compression.init_app(app)
     setup_db(app)
     CORS(app)
-    migrate = Migrate(app, db)
+    # Flask-Migrate pulls in Alembic, only the `flask db` commands need it
+    if os.environ.get('FLASK_RUN_FROM_CLI'):
+        from flask_migrate import Migrate
+        Migrate(app, db)
 
     # ROUTES
 
     @app.route('/')
     def status():
         return jsonify({'app': 'up'})
+
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
     '''
       GET /actors it should return list of actors
   '''
 
     @app.route('/actors')
     @requires_auth('get:actors')
+    @conditional('actors', 'cast', 'movies')
+    @cached('actors', 'cast', 'movies')
+    @read_replica('actors', 'cast', 'movies')
     def get_actors(token):
-        selection = Actor.query.order_by(Actor.id).all()
-        current_actors = paginate_results(request, selection)
-        if len(current_actors) == 0:
+        query = apply_filters(request, Actor, Actor.query)
+        fields = requested_fields(request, Actor)
+        formatter = None
+        # ?include=cast loads the movies of the whole page in one query
+        if includes(request, 'cast'):
+            query = query.options(selectinload(Actor.movies))
+            formatter = only(fields, format_actor_with_cast,
+                             'movies')
+        elif fields:
+            query, formatter = project(query, Actor, fields)
+        page = paginate(request, query, sort_keys(request, Actor), formatter)
+        if len(page['items']) == 0:
             abort(404)
-        return jsonify({
+        return jsonify(page_response('actors', page)), 200
+
+    '''
+      GET /actors/<id> returns a single actor
+  '''
+    @app.route('/actors/<int:id>')
+    @requires_auth('get:actors')
+    @read_replica('actors')
+    def get_actor(token, id):
+        found = get_formatted(Actor, id, requested_fields(request, Actor))
+        if found is None:
+            abort(404)
+        actor, version = found
+        # the row version is the ETag, so If-Match can take it back
+        return versioned(jsonify({
             'success': True,
-            'actors': current_actors
-        }), 200
+            'actor': actor
+        }), version)
+
+    '''
+      GET /actors/<id>/movies returns the movies an actor is cast in
+  '''
+    @app.route('/actors/<int:id>/movies')
+    @requires_auth('get:movies')
+    @conditional('actors', 'cast', 'movies')
+    @read_replica('actors', 'cast', 'movies')
+    def get_actor_movies(token, id):
+        if not exists(Actor, id):
+            abort(404)
+        query = Movie.query.join(cast, cast.c.movie_id == Movie.id) \
+            .filter(cast.c.actor_id == id)
+        formatter = None
+        fields = requested_fields(request, Movie)
+        if fields:
+            query, formatter = project(query, Movie, fields)
+        page = paginate(request, query, Movie.id, formatter)
+        return jsonify(page_response('movies', page)), 200
+
+    '''
+      GET /actors/search?q= returns the best matching actors first
+  '''
+    @app.route('/actors/search')
+    @requires_auth('get:actors')
+    @conditional('actors')
+    @cached('actors')
+    @read_replica('actors')
+    def search_actors(token):
+        page = search_page(request, Actor)
+        return jsonify(page_response('actors', page)), 200
+
+    '''
+      GET /actors/export streams every actor as NDJSON or CSV
+  '''
+    @app.route('/actors/export')
+    @requires_auth('get:actors')
+    @read_replica('actors')
+    def export_actors(token):
+        return export_response(Actor, 'actors')
 
     '''
     Create an endpoint to POST a new actor
@@ -53,42 +214,56 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['POST'])
     @requires_auth('add:actor')
     def create_actor(token):
-        body = request.get_json()
-        name = body.get('name')
-        age = body.get('age')
-        gender = body.get('gender')
-        if not(name and age and gender):
+        try:
+            fields = actor_fields(request.get_json(silent=True))
+        except ValidationError:
             abort(422)
         try:
-            actor = Actor(name=name, age=age, gender=gender)
+            actor = Actor(**fields)
             actor.insert()
             return jsonify({'success': True}), 200
         except Exception:
             abort(422)
 
+    '''
+    Create, update and delete many actors in a single transaction
+  '''
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('add:actor')
+    def bulk_create_actors(token):
+        return bulk_create(Actor, actor_fields)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('update:actor')
+    def bulk_update_actors(token):
+        return bulk_patch(Actor, actor_fields)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def bulk_delete_actors(token):
+        return bulk_remove(Actor)
+
     '''
       Create an endpoint to UPDATE actor's information
   '''
     @app.route('/actors/<int:id>', methods=['PATCH'])
     @requires_auth('update:actor')
     def update_actor(token, id):
-        actor = Actor.query.get(id)
-        if not actor:
-            abort(404)
-        body = request.get_json()
-        name = body.get('name')
-        age = body.get('age')
-        gender = body.get('gender')
-        if name:
-            actor.name = name
-        if age:
-            actor.age = age
-        if gender:
-            actor.gender = gender
-        actor.update()
+        try:
+            fields = actor_fields(request.get_json(silent=True),
+                                  partial=True)
+        except ValidationError:
+            abort(422)
+        if not fields:
+            # nothing would change, don't bump the version
+            abort(400, NO_FIELDS)
+        versions = if_match(request)
+        actor = update_row(Actor, id, fields, versions)
+        if actor is None:
+            write_failed(Actor, id, versions)
         return jsonify({
             'success': True,
-            'actor': actor.format()
+            'actor': actor
         }), 200
 
     '''
@@ -97,68 +272,205 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actor')
     def delete_actor(token, actor_id):
-        try:
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-            actor.delete()
-            return jsonify({
-                'success': True,
-            }), 200
-        except Exception:
-            abort(422)
+        versions = if_match(request)
+        if not delete_row(Actor, actor_id, versions):
+            write_failed(Actor, actor_id, versions)
+        return jsonify({
+            'success': True,
+        }), 200
     '''
       GET /moivies it should return list of movies
   '''
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @conditional('movies', 'cast', 'actors')
+    @cached('movies', 'cast', 'actors')
+    @read_replica('movies', 'cast', 'actors')
     def get_movies(token):
-        selection = Movie.query.order_by(Movie.id).all()
-        current_movies = paginate_results(request, selection)
-        if len(current_movies) == 0:
+        query = apply_filters(request, Movie, Movie.query)
+        fields = requested_fields(request, Movie)
+        formatter = None
+        # ?include=cast loads the actors of the whole page in one query
+        if includes(request, 'cast'):
+            query = query.options(selectinload(Movie.actors))
+            formatter = only(fields, format_movie_with_cast,
+                             'cast')
+        elif fields:
+            query, formatter = project(query, Movie, fields)
+        page = paginate(request, query, sort_keys(request, Movie), formatter)
+        if len(page['items']) == 0:
             abort(404)
+        return jsonify(page_response('movies', page)), 200
+
+    '''
+      GET /movies/<id> returns a single movie
+  '''
+    @app.route('/movies/<int:id>')
+    @requires_auth('get:movies')
+    @read_replica('movies')
+    def get_movie(token, id):
+        found = get_formatted(Movie, id, requested_fields(request, Movie))
+        if found is None:
+            abort(404)
+        movie, version = found
+        # the row version is the ETag, so If-Match can take it back
+        return versioned(jsonify({
+            'success': True,
+            'movie': movie
+        }), version)
+
+    '''
+      GET /movies/<id>/actors returns the cast of a movie
+  '''
+    @app.route('/movies/<int:id>/actors')
+    @requires_auth('get:actors')
+    @conditional('movies', 'cast', 'actors')
+    @read_replica('movies', 'cast', 'actors')
+    def get_movie_actors(token, id):
+        if not exists(Movie, id):
+            abort(404)
+        query = Actor.query.join(cast, cast.c.actor_id == Actor.id) \
+            .filter(cast.c.movie_id == id)
+        formatter = None
+        fields = requested_fields(request, Actor)
+        if fields:
+            query, formatter = project(query, Actor, fields)
+        page = paginate(request, query, Actor.id, formatter)
+        return jsonify(page_response('actors', page)), 200
+
+    '''
+      POST /movies/<id>/cast adds actors to the cast of a movie
+  '''
+    @app.route('/movies/<int:id>/cast', methods=['POST'])
+    @requires_auth('update:movie')
+    def create_cast(token, id):
+        body = request.get_json(silent=True) or {}
+        actor_ids = body.get('actor_ids')
+        if not isinstance(actor_ids, list) or not all(
+                isinstance(i, int) and not isinstance(i, bool)
+                for i in actor_ids):
+            abort(422)
+        if not exists(Movie, id):
+            abort(404)
+        found = {row.id for row in db.session.query(Actor.id)
+                 .filter(Actor.id.in_(actor_ids))}
+        if len(found) != len(set(actor_ids)):
+            abort(422)
+        added = add_cast(id, actor_ids)
         return jsonify({
             'success': True,
-            'movies': current_movies
+            'added': added
+        }), 200
+
+    '''
+      DELETE /movies/<id>/cast/<actor_id> removes an actor from a cast
+  '''
+    @app.route('/movies/<int:id>/cast/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('update:movie')
+    def delete_cast(token, id, actor_id):
+        if not remove_cast(id, actor_id):
+            abort(404)
+        return jsonify({
+            'success': True
         }), 200
 
+    '''
+      GET /movies/search?q= returns the best matching movies first
+  '''
+    @app.route('/movies/search')
+    @requires_auth('get:movies')
+    @conditional('movies')
+    @cached('movies')
+    @read_replica('movies')
+    def search_movies(token):
+        page = search_page(request, Movie)
+        return jsonify(page_response('movies', page)), 200
+
+    '''
+      GET /search?q= returns the best matching actors and movies
+  '''
+    @app.route('/search')
+    @requires_auth('get:actors')
+    @cached('actors', 'movies')
+    @read_replica('actors', 'movies')
+    def search_all(token):
+        check_permissions('get:movies', token)
+        # one page of each, the per resource routes page further
+        if request.args.get('after') or request.args.get('before'):
+            abort(400)
+        terms = search_terms(request)
+        results = {}
+        for name, model in (('actors', Actor), ('movies', Movie)):
+            query, keys = search(model, terms)
+            results[name] = paginate(request, query, keys)['items']
+        return jsonify(dict(results, success=True)), 200
+
+    '''
+      GET /movies/export streams every movie as NDJSON or CSV
+  '''
+    @app.route('/movies/export')
+    @requires_auth('get:movies')
+    @read_replica('movies')
+    def export_movies(token):
+        return export_response(Movie, 'movies')
+
     '''
       Create an endpoint to POST a new movie
   '''
     @app.route('/movies', methods=['POST'])
     @requires_auth('add:movie')
     def create_movie(token):
-        body = request.get_json()
-        title = body.get('title')
-        release_date = body.get('release_date')
-        if not(title and release_date):
+        try:
+            fields = movie_fields(request.get_json(silent=True))
+        except ValidationError:
             abort(422)
         try:
-            movie = Movie(title=title, release_date=release_date)
+            movie = Movie(**fields)
             movie.insert()
             return jsonify({'success': True}), 200
         except Exception:
             abort(422)
 
+    '''
+    Create, update and delete many movies in a single transaction
+  '''
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('add:movie')
+    def bulk_create_movies(token):
+        return bulk_create(Movie, movie_fields)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('update:movie')
+    def bulk_update_movies(token):
+        return bulk_patch(Movie, movie_fields)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def bulk_delete_movies(token):
+        return bulk_remove(Movie)
+
     '''
       Create an endpoint to UPDATE movie's information
   '''
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('update:movie')
     def update_movie(token, id):
-        movie = Movie.query.get(id)
-        if not movie:
-            abort(404)
-        body = request.get_json()
-        title = body.get('title')
-        release_date = body.get('release_date')
-        if title:
-            movie.title = title
-        if release_date:
-            movie.release_date = release_date
-        movie.update()
+        try:
+            fields = movie_fields(request.get_json(silent=True),
+                                  partial=True)
+        except ValidationError:
+            abort(422)
+        if not fields:
+            # nothing would change, don't bump the version
+            abort(400, NO_FIELDS)
+        versions = if_match(request)
+        movie = update_row(Movie, id, fields, versions)
+        if movie is None:
+            write_failed(Movie, id, versions)
         return jsonify({
             'success': True,
-            'movie': movie.format()
+            'movie': movie
         }), 200
     '''
     Create an endpoint to DELETE question using a movie ID.
@@ -166,14 +478,118 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movie')
     def delete_movie(token, movie_id):
+        versions = if_match(request)
+        if not delete_row(Movie, movie_id, versions):
+            write_failed(Movie, movie_id, versions)
+        return jsonify({
+            'success': True,
+        }), 200
+    '''
+      POST /import?resource=actors|movies loads an NDJSON or CSV body
+  '''
+    @app.route('/import', methods=['POST'])
+    @requires_auth()
+    def import_data(token):
+        resource = request.args.get('resource')
+        if resource not in RESOURCES:
+            abort(400)
+        check_permissions(RESOURCES[resource][2], token)
+
+        default = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        format = request.args.get('format', default)
+        chunk_size = request.args.get('chunk_size', IMPORT_CHUNK_SIZE,
+                                      type=int)
+        if format not in FORMATS or chunk_size < 1:
+            abort(400)
+
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8',
+                                  newline='')
         try:
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-            movie.delete()
-            return jsonify({
-                'success': True,
-            }), 200
+            report = import_rows(resource, read_rows(stream, format),
+                                 chunk_size=chunk_size)
+        except UnicodeDecodeError:
+            abort(400)
         except Exception:
             abort(422)
+        return jsonify(dict(report, success=True)), 200
+
+    '''
+      GET /stats returns the actor and movie counts of the dashboards
+  '''
+    @app.route('/stats')
+    @requires_auth('get:actors')
+    @cached('actors', 'movies')
+    @read_replica('actors', 'movies')
+    def get_stats(token):
+        check_permissions('get:movies', token)
+        return jsonify(dict(read_stats(), success=True)), 200
+
+    @app.route('/stats/actors')
+    @requires_auth('get:actors')
+    @conditional('actors')
+    @cached('actors')
+    @read_replica('actors')
+    def get_actor_stats(token):
+        return jsonify({
+            'success': True,
+            'actors': read_stats()['actors']
+        }), 200
+
+    @app.route('/stats/movies')
+    @requires_auth('get:movies')
+    @conditional('movies')
+    @cached('movies')
+    @read_replica('movies')
+    def get_movie_stats(token):
+        return jsonify({
+            'success': True,
+            'movies': read_stats()['movies']
+        }), 200
+
+    '''
+      /admin/queries reports the statements recorded by the SQL
+      profiler, only when SQL_PROFILE is on
+  '''
+    @app.route('/admin/queries')
+    @requires_auth('read:queries')
+    def get_queries(token):
+        if profiler is None:
+            abort(404)
+        order = request.args.get('order', 'total')
+        count = request.args.get('top', 20, type=int)
+        if order not in profiler.ORDERS or count < 1:
+            abort(400)
+        return jsonify({
+            'success': True,
+            'slow_query_ms': profiler.slow_seconds * 1000,
+            'statements': profiler.top(count, order)
+        }), 200
+
+    @app.route('/admin/queries/<id>/explain', methods=['POST'])
+    @requires_auth('read:queries')
+    def explain_query(token, id):
+        if profiler is None:
+            abort(404)
+        try:
+            plan = profiler.explain(db.engine, id)
+        except Exception:
+            abort(422)
+        if plan is None:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'id': id,
+            'plan': plan
+        }), 200
+
+    @app.route('/admin/queries', methods=['DELETE'])
+    @requires_auth('read:queries')
+    def reset_queries(token):
+        if profiler is None:
+            abort(404)
+        profiler.reset()
+        return jsonify({'success': True}), 200
+
     '''
   Create error handlers for all expected errors
   '''
@@ -193,12 +609,42 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 422
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+        })
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        })
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
             "success": False,
             "error": 400,
-            "message": "bad request"
+            "message": NO_FIELDS if error.description == NO_FIELDS
+            else "bad request"
         }), 400
 
     @app.errorhandler(AuthError)
@@ -211,7 +657,20 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # `app` is built on first access (gunicorn app:app, flask run), not
+    # when the module is imported for create_app or by tools
+    if name != 'app':
+        raise AttributeError(name)
+    with _app_lock:
+        if 'app' not in globals():
+            globals()['app'] = create_app()
+    return globals()['app']
+
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,182 @@
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+ASGI entry point
+
+    uvicorn asgi:application --workers 4
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker asgi:application
+
+serves the application of create_app(), same routes, same
+requires_auth, from an ASGI server. Connections are held by the event
+loop, so idle and slow clients cost no thread. Each request is handed to
+a pool of ASGI_THREADS threads (default 16) while it runs. The views and
+psycopg2 stay synchronous (Flask 1.1 has no async views), but a thread
+waiting on PostgreSQL or on a JWKS fetch releases the GIL, so a worker
+overlaps that many requests instead of one. Keep ASGI_THREADS at or
+below DB_POOL_SIZE + DB_MAX_OVERFLOW, or the extra threads just queue
+for a connection.
+
+Request bodies are streamed to the view (POST /import reads them chunk
+by chunk) and response iterables are streamed back (the exports).
+On lifespan startup the JWKS is fetched and its refresher started off
+the event loop, so the first requests don't wait on the identity
+provider.
+'''
+
+
+class _RequestBody(io.RawIOBase):
+    """wsgi.input reading the ASGI http.request messages as the view
+    consumes them.
+    """
+
+    def __init__(self, receive, loop, body=b'', more_body=True):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = body
+        self._more_body = more_body
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(
+                self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self._more_body = False
+            else:
+                self._buffer = message.get('body', b'')
+                self._more_body = message.get('more_body', False)
+        count = min(len(buffer), len(self._buffer))
+        buffer[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+        .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # chunked bodies have no Content-Length, read them to the end
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+class ASGIAdapter:
+    def __init__(self, wsgi_app, threads=16):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await loop.run_in_executor(self.executor, self.startup)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def startup(self):
+        from auth.auth import get_jwks_store
+        get_jwks_store().start()
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        # the first message usually holds the whole body already
+        message = await receive()
+        body = io.BufferedReader(_RequestBody(
+            receive, loop, message.get('body', b''),
+            message.get('more_body', False)))
+        environ = build_environ(scope, body)
+        await loop.run_in_executor(
+            self.executor, self.run_wsgi, environ, send, loop)
+
+    def run_wsgi(self, environ, send, loop):
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+
+        def send_start():
+            status, headers = started
+            send_message({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]
+            })
+
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            sent_start = False
+            for chunk in iterable:
+                if not sent_start:
+                    send_start()
+                    sent_start = True
+                if chunk:
+                    send_message({'type': 'http.response.body',
+                                  'body': chunk, 'more_body': True})
+            if not sent_start:
+                send_start()
+            send_message({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+def create_application(wsgi_app=None):
+    if wsgi_app is None:
+        from app import app as wsgi_app
+    return ASGIAdapter(wsgi_app,
+                       threads=int(os.environ.get('ASGI_THREADS', 16)))
+
+
+application = create_application()
@@ -1,14 +1,112 @@
 import os
-import json
+import threading
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from auth.jwks import JWKSKeyStore
+from auth.token_cache import VerifiedTokenCache
+import metrics
+import rate_limit
+from instrumentation import phase
+
+'''
+Settings
+
+AUTH0_DOMAIN, ALGORITHMS and API_AUDIENCE are read from the environment
+when a token is first verified rather than at import, so tools that
+never check a token (migrations, the import CLI) run without them.
+python-jose is imported on first use too; preload() imports it and the
+signing keys ahead of time, e.g. in the gunicorn master before it forks.
+'''
+
+
+def auth0_domain():
+    return os.environ['AUTH0_DOMAIN']
+
+
+def algorithms():
+    return [os.environ['ALGORITHMS']]
 
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = [os.environ['ALGORITHMS']]
-API_AUDIENCE = os.environ['API_AUDIENCE']
+def api_audience():
+    return os.environ['API_AUDIENCE']
+
+
+def prepare_key(key):
+    """Converts a JWK into the public key object jwt.decode verifies
+    with, so it is only built once per key set load.
+    """
+    from jose import jwk
+    if key.get('use', 'sig') != 'sig':
+        raise ValueError('JWK {} is not a signing key'.format(key['kid']))
+    return jwk.construct({
+        'kty': key['kty'],
+        'kid': key['kid'],
+        'use': key.get('use', 'sig'),
+        'n': key['n'],
+        'e': key['e']
+    }, algorithms()[0])
+
+
+_jwks_store = None
+_jwks_store_lock = threading.Lock()
+
+
+def get_jwks_store():
+    """Returns the JWKS cache of the process, created on first use.
+    JWKS_FILE seeds it from disk and JWKS_URL may point to a local
+    stand-in (or be empty to never fetch).
+    """
+    global _jwks_store
+    if _jwks_store is None:
+        with _jwks_store_lock:
+            if _jwks_store is None:
+                _jwks_store = JWKSKeyStore(
+                    os.environ.get(
+                        'JWKS_URL', 'https://{}/.well-known/jwks.json'
+                        .format(auth0_domain())),
+                    ttl=int(os.environ.get('JWKS_CACHE_TTL', 600)),
+                    refresh_margin=int(
+                        os.environ.get('JWKS_REFRESH_MARGIN', 60)),
+                    min_refetch_interval=int(
+                        os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30)),
+                    seed_file=os.environ.get('JWKS_FILE'),
+                    prepare=prepare_key)
+    return _jwks_store
+
+
+def preload():
+    """Imports python-jose and loads the signing keys, so processes
+    forked afterwards share them instead of loading them on their first
+    request.
+    """
+    from jose import jwk, jwt  # noqa: F401
+    get_jwks_store().prefetch()
+
+
+# verified tokens, repeated bearer tokens skip the signature check
+token_cache = VerifiedTokenCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)),
+    leeway=int(os.environ.get('TOKEN_CACHE_LEEWAY', 30)))
+
+
+@metrics.register
+def token_cache_metrics():
+    stats = token_cache.stats()
+    return [
+        ('auth_token_cache_hits_total', 'counter',
+         'Requests served from the verified-token cache.',
+         [({}, stats['hits'])]),
+        ('auth_token_cache_misses_total', 'counter',
+         'Requests that had to verify the token signature.',
+         [({}, stats['misses'])]),
+        ('auth_token_cache_evictions_total', 'counter',
+         'Verified tokens evicted to stay within TOKEN_CACHE_SIZE.',
+         [({}, stats['evictions'])]),
+        ('auth_token_cache_size', 'gauge',
+         'Verified tokens currently cached.',
+         [({}, stats['size'])])
+    ]
+
 
 # AuthError Exception
 '''
@@ -99,42 +197,39 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # SKIP THE VERIFICATION FOR TOKENS WE ALREADY VERIFIED
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    from jose import jwt
 
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # GET THE PREPARED PUBLIC KEY FROM THE CACHED AUTH0 JWKS
+    with phase('jwks'):
+        rsa_key = get_jwks_store().get_key(unverified_header['kid'])
     # Finally, verify!!!
-    if rsa_key:
+    if rsa_key is not None:
         try:
             # USE THE KEY TO VALIDATE THE JWT
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=algorithms(),
+                audience=api_audience(),
+                issuer='https://' + auth0_domain() + '/'
             )
 
+            token_cache.put(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -171,6 +266,9 @@ def verify_decode_jwt(token):
     method validate claims and check the requested permission
     return the decorator which passes
     the decoded payload to the decorated method
+
+    without a permission only the token is verified, for views that
+    pick the permission to check from the request themselves
 '''
 
 
@@ -178,16 +276,19 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except BaseException:
-                raise AuthError({
-                    'code': 'invalid_token',
-                    'description': 'Access denied due to invalid token'
-                }, 401)
-
-            check_permissions(permission, payload)
+            with phase('auth'):
+                token = get_token_auth_header()
+                try:
+                    payload = verify_decode_jwt(token)
+                except BaseException:
+                    raise AuthError({
+                        'code': 'invalid_token',
+                        'description': 'Access denied due to invalid token'
+                    }, 401)
+
+            if permission:
+                check_permissions(permission, payload)
+            rate_limit.check(payload, permission)
 
             return f(payload, *args, **kwargs)
 
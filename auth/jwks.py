@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKSKeyStore
+    caches the JSON Web Key Set of the identity provider per process
+
+    keys are fetched once and served from memory for `ttl` seconds, a
+    daemon thread refreshes them `refresh_margin` seconds before they
+    expire, and an unknown `kid` (key rotation) triggers at most one
+    refetch every `min_refetch_interval` seconds. If a refresh fails the
+    last known keys keep being served.
+
+    `prepare` converts each JWK once, when the key set is loaded, into
+    whatever the verifier wants (e.g. a ready-to-use public key object);
+    keys it rejects are skipped.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, refresh_margin=60,
+                 min_refetch_interval=30, timeout=5, seed_file=None,
+                 prepare=None):
+        self.url = url
+        self.prepare = prepare
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl / 2)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+        if seed_file:
+            self.load_file(seed_file)
+
+    def load(self, jwks):
+        """Replaces the cached key set with the given parsed JWKS."""
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            if self.prepare is not None:
+                try:
+                    keys[key['kid']] = self.prepare(key)
+                except Exception:
+                    logger.warning('Skipping unusable JWK %s', key['kid'],
+                                   exc_info=True)
+                continue
+            keys[key['kid']] = key
+        self._keys = keys
+        self._expires_at = time.time() + self.ttl
+
+    def load_file(self, path):
+        with open(path) as f:
+            self.load(json.load(f))
+
+    def fetch(self):
+        response = urlopen(self.url, timeout=self.timeout)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+
+    def refresh(self, force=False):
+        """Fetches the key set unless another thread just did.
+
+        Returns True if the cache was reloaded. Fetch errors are only
+        raised when there is no key set to fall back to.
+        """
+        with self._lock:
+            now = time.time()
+            if not force and self._keys and now < self._expires_at:
+                return False
+            if self._keys and \
+                    now - self._last_fetch < self.min_refetch_interval:
+                return False
+            self._last_fetch = now
+            try:
+                self.load(self.fetch())
+            except Exception:
+                if not self._keys:
+                    raise
+                logger.warning('Failed to refresh JWKS from %s, serving '
+                               'cached keys', self.url, exc_info=True)
+                return False
+            return True
+
+    def get_key(self, kid):
+        """Returns the (prepared) key with the given `kid`, or None if
+        the identity provider does not know it.
+        """
+        expired = time.time() >= self._expires_at
+        if self.url and (not self._keys or expired):
+            self.refresh()
+        self._ensure_refresher()
+        key = self._keys.get(kid)
+        if key is None and self.url:
+            # the provider may have rotated its keys since our last fetch
+            if self.refresh(force=True):
+                key = self._keys.get(kid)
+        return key
+
+    def prefetch(self):
+        """Loads the key set unless it is fresh, logging failures."""
+        if not self.url:
+            return
+        try:
+            self.refresh()
+        except Exception:
+            logger.warning('Failed to prefetch JWKS from %s', self.url,
+                           exc_info=True)
+
+    def start(self):
+        """Loads the key set and starts the background refresher ahead
+        of the first request, so no request has to wait for a fetch.
+        """
+        self.prefetch()
+        self._ensure_refresher()
+
+    def _ensure_refresher(self):
+        # threads do not survive fork(), so every worker starts its own
+        if not self.url or self._refresher_pid == os.getpid():
+            return
+        self._refresher_pid = os.getpid()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop, name='jwks-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            delay = self._expires_at - self.refresh_margin - time.time()
+            time.sleep(max(delay, self.min_refetch_interval, 1))
+            try:
+                self.refresh(force=True)
+            except Exception:
+                logger.warning('Background JWKS refresh failed',
+                               exc_info=True)
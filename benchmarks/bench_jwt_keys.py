@@ -0,0 +1,70 @@
+'''
+Micro-benchmark of the per-request cost of verifying a RS256 token with
+a JWK dict (what verify_decode_jwt used to build on every request) versus
+a key object prepared once when the key set loads.
+
+    python benchmarks/bench_jwt_keys.py [iterations]
+'''
+import base64
+import sys
+import time
+
+import rsa
+from jose import jwk, jwt
+
+
+def b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def make_token_and_jwks():
+    public, private = rsa.newkeys(2048)
+    token = jwt.encode(
+        {'sub': 'bench', 'aud': 'bench', 'iss': 'https://bench/',
+         'exp': int(time.time()) + 3600, 'permissions': ['get:actors']},
+        private.save_pkcs1().decode('ascii'), algorithm='RS256',
+        headers={'kid': 'bench'})
+    jwks = {'keys': [{'kty': 'RSA', 'kid': 'bench', 'use': 'sig',
+                      'n': b64_uint(public.n), 'e': b64_uint(public.e)}]}
+    return token, jwks
+
+
+def per_call(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations=500):
+    token, jwks = make_token_and_jwks()
+    options = {'algorithms': ['RS256'], 'audience': 'bench',
+               'issuer': 'https://bench/'}
+
+    def per_request_dict():
+        header = jwt.get_unverified_header(token)
+        for key in jwks['keys']:
+            if key['kid'] == header['kid']:
+                rsa_key = {'kty': key['kty'], 'kid': key['kid'],
+                           'use': key['use'], 'n': key['n'], 'e': key['e']}
+        return jwt.decode(token, rsa_key, **options)
+
+    keys = {key['kid']: jwk.construct(key, 'RS256') for key in jwks['keys']}
+
+    def prepared_key():
+        header = jwt.get_unverified_header(token)
+        return jwt.decode(token, keys[header['kid']], **options)
+
+    results = {
+        'jwk dict per request': per_call(per_request_dict, iterations),
+        'prepared key object': per_call(prepared_key, iterations)
+    }
+    for name, seconds in results.items():
+        print('{:<22} {:8.1f} us/verify'.format(name, seconds * 1e6))
+    saved = results['jwk dict per request'] - results['prepared key object']
+    print('{:<22} {:8.1f} us/verify'.format('saving', saved * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
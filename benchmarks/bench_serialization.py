@@ -0,0 +1,79 @@
+'''
+Benchmark of the cost of turning a page of movies into a JSON response:
+ORM objects + format() + flask.jsonify (the original path) against
+the Bundle projection of ?fields= and serialization.jsonify, with
+orjson and with the stdlib fallback. Runs on an in-memory SQLite
+database, so the query part is a lower bound of what PostgreSQL costs.
+
+    python benchmarks/bench_serialization.py [iterations]
+'''
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask, jsonify as flask_jsonify  # noqa: E402
+from models import Movie, db, setup_db  # noqa: E402
+from fields import project  # noqa: E402
+import serialization  # noqa: E402
+
+PAGE_SIZES = (10, 100, 1000)
+
+
+def per_call(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations=200):
+    app = Flask(__name__)
+    setup_db(app, 'sqlite://')
+    with app.app_context():
+        db.create_all()
+        start = datetime(2000, 1, 1)
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': 'Movie {}'.format(i),
+             'release_date': start + timedelta(days=i)}
+            for i in range(max(PAGE_SIZES))])
+        db.session.commit()
+        fields = Movie.format_fields
+
+        with app.test_request_context():
+            for size in PAGE_SIZES:
+                def orm_format_jsonify():
+                    movies = Movie.query.order_by(Movie.id).limit(size)
+                    return flask_jsonify(
+                        {'movies': [movie.format() for movie in movies]})
+
+                def projection_jsonify():
+                    query, formatter = project(
+                        Movie.query.order_by(Movie.id), Movie, fields)
+                    return serialization.jsonify({'movies': [
+                        formatter(row[0]) for row in query.limit(size)]})
+
+                orjson = serialization.orjson
+                results = {
+                    'orm + flask.jsonify': per_call(
+                        orm_format_jsonify, iterations),
+                    'projection + orjson': per_call(
+                        projection_jsonify, iterations)
+                }
+                serialization.orjson = None
+                results['projection + stdlib'] = per_call(
+                    projection_jsonify, iterations)
+                serialization.orjson = orjson
+                if orjson is None:
+                    del results['projection + orjson']
+
+                print('{} rows'.format(size))
+                for name, seconds in results.items():
+                    print('  {:<22} {:10.1f} us/page'.format(
+                        name, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,105 @@
+'''
+Benchmark of how fast a fresh worker process gets ready: the time to
+import app.py, to build the app with create_app(), and to answer its
+first request, measured in new interpreters. The heaviest imports are
+listed from python -X importtime.
+
+    python benchmarks/bench_startup.py [-n runs] [--path /] [--modules 10]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# runs in the child interpreter, prints its timings as JSON
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get(sys.argv[1])
+served = time.perf_counter()
+print(json.dumps({
+    'status': response.status_code,
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'ready_ms': (served - start) * 1000}))
+'''
+
+
+def child_env(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT, env.get('PYTHONPATH')]))
+    return env
+
+
+def run_once(path, env):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, path], cwd=ROOT, env=env,
+        check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    # interpreter start included
+    result['process_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def heaviest_imports(env, count):
+    """Returns the `count` top-level imports of app.py that took the
+    longest, with their cumulative time in ms.
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, env=env, check=True, capture_output=True,
+        text=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # direct imports of app.py are indented by two spaces
+        if name.startswith('   ') and not name.startswith('    '):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    imports.sort(reverse=True)
+    return [{'module': name, 'ms': round(ms, 1)}
+            for ms, name in imports[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--path', default='/',
+                        help='route of the first request')
+    parser.add_argument('--modules', type=int, default=10,
+                        help='how many of the heaviest imports to list')
+    parser.add_argument('--database-url',
+                        help='defaults to a throwaway SQLite file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'startup.db')
+        env = child_env(database_url)
+        runs = [run_once(args.path, env) for _ in range(args.runs)]
+        report = {
+            name: round(statistics.median(run[name] for run in runs), 1)
+            for name in ('import_ms', 'create_app_ms', 'first_request_ms',
+                         'ready_ms', 'process_ms')}
+        report['status'] = runs[-1]['status']
+        report['runs'] = args.runs
+        report['heaviest_imports'] = heaviest_imports(env, args.modules)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
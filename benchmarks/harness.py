@@ -0,0 +1,468 @@
+'''
+Benchmark suite of the API routes, with no Auth0 and no shared database
+needed.
+
+    python benchmarks/harness.py [--actors 10000] [--movies 2000]
+        [--concurrency 16] [--duration 5] [--route actors ...]
+        [--database-url sqlite:///...] [--output results.json]
+        [--compare baseline.json]
+
+It
+* creates the schema in --database-url (default: a SQLite file in the
+  temp directory) and seeds it with --actors / --movies rows and a cast.
+  Every table of that database is DROPPED first, never point it at a
+  database holding data you want to keep;
+* signs RS256 tokens with a key generated for the run and serves the
+  matching JWKS on localhost, so requires_auth runs unchanged;
+* serves the app on a local port and drives every route (or the
+  --route names given) for --duration seconds at --concurrency. The
+  writes only change and delete rows created for them, which are
+  deleted after each route;
+* prints, or writes to --output, a JSON report with the throughput,
+  the p50 / p95 / p99 latency and the SQL statements per request of
+  each route, plus the commit it ran on, to diff across commits;
+  --compare old.json prints the change against an earlier report.
+
+The response cache is off unless --response-cache local is given, and
+request coalescing and rate limits are always off, whatever the
+environment says, so the numbers measure the views and the database.
+The admin_* routes need --sql-profile, which slows every route down.
+'''
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import load  # noqa: E402
+
+DOMAIN = 'bench.local'
+AUDIENCE = 'bench'
+PERMISSIONS = ['add:actor', 'add:movie', 'delete:actor', 'delete:movie',
+               'get:actors', 'get:movies', 'update:actor', 'update:movie',
+               'read:queries']
+
+# name of the rows the write routes create, change and delete
+THROWAWAY = 'Throwaway'
+ACTOR = {'name': THROWAWAY, 'age': 30, 'gender': 'F'}
+MOVIE = {'title': THROWAWAY, 'release_date': '2000-01-01'}
+
+# name: (method, path, body), the body is sent as JSON unless it is a
+# str, or called with the ids of the request when it is a function.
+# {actor} / {movie} pick a seeded id, the writes only touch throwaway
+# rows: {throwaway_actor} / {throwaway_movie} one per route,
+# {fresh_actor} / {fresh_movie} a new one per request, {fresh_cast} a
+# new movie with {actor} in its cast. {query} is a statement of the SQL
+# profiler (--sql-profile).
+ROUTES = {
+    'status': ('GET', '/', None),
+    'actors': ('GET', '/actors', None),
+    'actors_sorted': ('GET', '/actors?sort=-age,name&age_min=30', None),
+    'actors_fields': ('GET', '/actors?fields=id,name&limit=100', None),
+    'actors_cast': ('GET', '/actors?include=cast', None),
+    'actor': ('GET', '/actors/{actor}', None),
+    'actor_movies': ('GET', '/actors/{actor}/movies', None),
+    'actors_search': ('GET', '/actors/search?q=smith', None),
+    'actors_export': ('GET', '/actors/export', None),
+    'movies': ('GET', '/movies', None),
+    'movies_cast': ('GET', '/movies?include=cast', None),
+    'movie': ('GET', '/movies/{movie}', None),
+    'movie_actors': ('GET', '/movies/{movie}/actors', None),
+    'movies_search': ('GET', '/movies/search?q=the', None),
+    'movies_export': ('GET', '/movies/export', None),
+    'search': ('GET', '/search?q=the', None),
+    'stats': ('GET', '/stats', None),
+    'stats_actors': ('GET', '/stats/actors', None),
+    'stats_movies': ('GET', '/stats/movies', None),
+    'create_actor': ('POST', '/actors', ACTOR),
+    'update_actor': ('PATCH', '/actors/{throwaway_actor}', {'age': 40}),
+    'delete_actor': ('DELETE', '/actors/{fresh_actor}', None),
+    'bulk_create_actors': ('POST', '/actors/bulk', [ACTOR] * 10),
+    'bulk_update_actors': ('PATCH', '/actors/bulk', lambda ids: [
+        {'id': ids['throwaway_actor'], 'age': 41}]),
+    'bulk_delete_actors': ('DELETE', '/actors/bulk', lambda ids: [
+        ids['fresh_actor']]),
+    'create_movie': ('POST', '/movies', MOVIE),
+    'update_movie': ('PATCH', '/movies/{throwaway_movie}',
+                     {'release_date': '2001-01-01'}),
+    'delete_movie': ('DELETE', '/movies/{fresh_movie}', None),
+    'bulk_create_movies': ('POST', '/movies/bulk', [MOVIE] * 10),
+    'bulk_update_movies': ('PATCH', '/movies/bulk', lambda ids: [
+        {'id': ids['throwaway_movie'], 'release_date': '2002-01-01'}]),
+    'bulk_delete_movies': ('DELETE', '/movies/bulk', lambda ids: [
+        ids['fresh_movie']]),
+    'add_cast': ('POST', '/movies/{fresh_movie}/cast',
+                 lambda ids: {'actor_ids': [ids['actor']]}),
+    'remove_cast': ('DELETE', '/movies/{fresh_cast}/cast/{actor}', None),
+    'import_actors': ('POST', '/import?resource=actors&format=ndjson',
+                      (json.dumps(ACTOR) + '\n') * 10),
+    'admin_queries': ('GET', '/admin/queries', None),
+    'admin_explain': ('POST', '/admin/queries/{query}/explain', None),
+    'admin_reset': ('DELETE', '/admin/queries', None),
+    'metrics': ('GET', '/metrics', None)
+}
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer',
+               'Michael', 'Linda', 'William', 'Elizabeth']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia',
+              'Miller', 'Davis', 'Rodriguez', 'Martinez']
+WORDS = ['The', 'Last', 'Night', 'Return', 'City', 'Dark', 'Love', 'War',
+         'Star', 'River']
+
+
+def b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def make_signer():
+    """Returns (jwks, mint) for a fresh RS256 key pair."""
+    import rsa
+    from jose import jwt
+    public, private = rsa.newkeys(2048)
+    pem = private.save_pkcs1().decode('ascii')
+    jwks = {'keys': [{'kty': 'RSA', 'kid': 'bench', 'use': 'sig',
+                      'alg': 'RS256', 'n': b64_uint(public.n),
+                      'e': b64_uint(public.e)}]}
+
+    def mint(permissions=PERMISSIONS, subject='bench'):
+        now = int(time.time())
+        return jwt.encode(
+            {'iss': 'https://{}/'.format(DOMAIN), 'aud': AUDIENCE,
+             'sub': subject, 'iat': now, 'exp': now + 3600,
+             'permissions': permissions},
+            pem, algorithm='RS256', headers={'kid': 'bench'})
+    return jwks, mint
+
+
+def serve_jwks(jwks):
+    body = json.dumps(jwks).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/.well-known/jwks.json'.format(
+        server.server_port)
+
+
+def seed(db, Actor, Movie, cast, actors, movies, cast_size=5):
+    rng = random.Random(42)
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': '{} {}'.format(rng.choice(FIRST_NAMES),
+                                rng.choice(LAST_NAMES)),
+         'age': rng.randint(18, 80), 'gender': rng.choice('MF')}
+        for _ in range(actors)])
+    start = datetime(1950, 1, 1)
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': ' '.join(rng.sample(WORDS, 3)),
+         'release_date': start + timedelta(days=rng.randint(0, 27000))}
+        for _ in range(movies)])
+    if actors:
+        db.session.execute(cast.insert(), [
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id in range(1, movies + 1)
+            for actor_id in set(rng.randint(1, actors)
+                                for _ in range(cast_size))])
+    db.session.commit()
+
+
+class Throwaway:
+    """Rows for the write routes, so they leave the seeded rows the
+    reads measure alone. They are written through an engine of their
+    own, outside of the timings and the statement counts.
+    """
+    batch = 100
+
+    def __init__(self, url):
+        from sqlalchemy import create_engine
+        from models import Actor, Movie, cast
+        self.engine = create_engine(url)
+        self.cast = cast
+        # table: (name column, values of a row)
+        self.tables = {
+            Actor.__table__: (Actor.__table__.c.name, ACTOR),
+            Movie.__table__: (Movie.__table__.c.title,
+                              dict(MOVIE, release_date=datetime(2000, 1, 1)))
+        }
+        self.actors, self.movies = Actor.__table__, Movie.__table__
+        self._free = {table: [] for table in self.tables}
+        self._lock = threading.Lock()
+
+    def new(self, table):
+        """Returns the id of a throwaway row nobody else got."""
+        from sqlalchemy import func, select
+        name, values = self.tables[table]
+        with self._lock:
+            free = self._free[table]
+            if not free:
+                with self.engine.begin() as connection:
+                    last = connection.execute(
+                        select(func.max(table.c.id))).scalar() or 0
+                    connection.execute(table.insert(), [values] * self.batch)
+                    free.extend(connection.execute(
+                        select(table.c.id)
+                        .where((table.c.id > last) & (name == THROWAWAY))
+                        .order_by(table.c.id.desc())).scalars())
+            return free.pop()
+
+    def new_cast(self, actor_id):
+        """Returns a throwaway movie with `actor_id` in its cast."""
+        movie_id = self.new(self.movies)
+        with self.engine.begin() as connection:
+            connection.execute(self.cast.insert().values(
+                movie_id=movie_id, actor_id=actor_id))
+        return movie_id
+
+    def clear(self):
+        """Deletes the throwaway rows, including those the routes
+        created.
+        """
+        from sqlalchemy import select
+        with self.engine.begin() as connection:
+            for table, (name, _) in self.tables.items():
+                ids = select(table.c.id).where(name == THROWAWAY)
+                column = 'actor_id' if table is self.actors else 'movie_id'
+                connection.execute(self.cast.delete().where(
+                    self.cast.c[column].in_(ids)))
+                connection.execute(table.delete().where(name == THROWAWAY))
+        with self._lock:
+            for free in self._free.values():
+                free.clear()
+
+
+class Ids(dict):
+    """The placeholder values of a route, computed on first use: a
+    function of `lazy` runs once per route, a fresh_* placeholder once
+    per request (see request()).
+    """
+
+    def __init__(self, ids, lazy, fresh):
+        super().__init__(ids)
+        self.lazy = lazy
+        self.fresh = fresh
+        self._lock = threading.Lock()
+
+    def __missing__(self, key):
+        if key not in self.lazy:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self:
+                self[key] = self.lazy[key]()
+            return dict.__getitem__(self, key)
+
+    def request(self):
+        """Returns the placeholder values of one request."""
+        return _RequestIds(self)
+
+
+class _RequestIds(dict):
+    def __init__(self, route):
+        super().__init__()
+        self.route = route
+
+    def __missing__(self, key):
+        fresh = self.route.fresh
+        value = fresh[key]() if key in fresh else self.route[key]
+        self[key] = value
+        return value
+
+
+def top_query(base, headers):
+    """Returns the id of the statement the profiler spent most time
+    in, or 0 when profiling is off.
+    """
+    import urllib.request
+    try:
+        with urllib.request.urlopen(urllib.request.Request(
+                base + '/admin/queries?top=1', headers=headers)) as res:
+            statements = json.load(res)['statements']
+    except OSError:
+        return 0
+    return statements[0]['id'] if statements else 0
+
+
+def requests(path, body, ids):
+    """Returns the next_request function of load.run for a route."""
+    def next_request():
+        values = ids.request()
+        data = body(values) if callable(body) else body
+        if data is not None and not isinstance(data, str):
+            data = json.dumps(data)
+        return path.format_map(values), data
+    return next_request
+
+
+def compare(report, baseline):
+    """Prints the throughput and p99 change of every route found in
+    both reports.
+    """
+    def change(new, old):
+        if not old or new is None:
+            return '    n/a'
+        return '{:+6.1f}%'.format((new - old) / old * 100)
+
+    print('{:<16} {:>12} {:>12} {:>10}'.format(
+        'vs ' + str(baseline.get('commit')), 'throughput', 'p99', 'sql/req'),
+        file=sys.stderr)
+    for name, result in report['routes'].items():
+        old = baseline.get('routes', {}).get(name)
+        if old is None:
+            continue
+        statements = '{} -> {}'.format(old['statements_per_request'],
+                                       result['statements_per_request'])
+        print('{:<16} {:>12} {:>12} {:>10}'.format(
+            name, change(result['throughput'], old['throughput']),
+            change(result['latency_ms']['p99'], old['latency_ms']['p99']),
+            statements), file=sys.stderr)
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route of the API.')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=5)
+    parser.add_argument('--route', action='append', choices=sorted(ROUTES),
+                        help='only run these routes, may be repeated')
+    parser.add_argument('--database-url', default='sqlite:///{}'.format(
+        os.path.join(tempfile.gettempdir(), 'capstone-bench.db')))
+    parser.add_argument('--response-cache', default='none',
+                        choices=('none', 'local'))
+    parser.add_argument('--sql-profile', action='store_true',
+                        help='turn the SQL profiler on, the admin_* '
+                        'routes answer 404 without it')
+    parser.add_argument('--output', help='write the report to this file')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='print the change against an earlier report')
+    args = parser.parse_args()
+
+    jwks, mint = make_signer()
+    # auth.auth and models read these at import time
+    os.environ.update({
+        'AUTH0_DOMAIN': DOMAIN,
+        'ALGORITHMS': 'RS256',
+        'API_AUDIENCE': AUDIENCE,
+        'JWKS_URL': serve_jwks(jwks),
+        'DATABASE_URL': args.database_url,
+        'RESPONSE_CACHE': args.response_cache,
+        'SINGLE_FLIGHT': 'false',
+        'RATE_LIMIT': '',
+        'RATE_LIMITS': '',
+        'MAX_CONCURRENT_REQUESTS': '0',
+        'SQL_PROFILE': 'true' if args.sql_profile else 'false'
+    })
+
+    from sqlalchemy import event
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import app
+    from models import Actor, Movie, cast, db
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(db, Actor, Movie, cast, args.actors, args.movies)
+        seeded = time.perf_counter() - started
+        engine = db.engine
+
+    statements = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(*args):
+        statements[0] += 1
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    headers = {'Authorization': 'Bearer ' + mint(),
+               'Content-Type': 'application/json'}
+    ids = {'actor': max(args.actors // 2, 1),
+           'movie': max(args.movies // 2, 1)}
+    rows = Throwaway(engine.url)
+    lazy = {'throwaway_actor': lambda: rows.new(rows.actors),
+            'throwaway_movie': lambda: rows.new(rows.movies),
+            'query': lambda: top_query(base, headers)}
+    fresh = {'fresh_actor': lambda: rows.new(rows.actors),
+             'fresh_movie': lambda: rows.new(rows.movies),
+             'fresh_cast': lambda: rows.new_cast(ids['actor'])}
+
+    report = {
+        'commit': commit(),
+        'database': engine.dialect.name,
+        'actors': args.actors,
+        'movies': args.movies,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'response_cache': args.response_cache,
+        'sql_profile': args.sql_profile,
+        'seed_seconds': round(seeded, 3),
+        'routes': {}
+    }
+    for name in args.route or ROUTES:
+        method, path, body = ROUTES[name]
+        before = statements[0]
+        result = load.run(base, args.concurrency, args.duration, headers,
+                          method, next_request=requests(
+                              path, body, Ids(ids, lazy, fresh)))
+        rows.clear()
+        result['statements_per_request'] = round(
+            (statements[0] - before) / result['requests'], 2) \
+            if result['requests'] else None
+        report['routes'][name] = dict(result, method=method, path=path)
+        print('{:<16} {:>8} req/s  p50 {:>8} ms  p99 {:>8} ms  {} sql/req'
+              .format(name, result['throughput'],
+                      result['latency_ms']['p50'],
+                      result['latency_ms']['p99'],
+                      result['statements_per_request']), file=sys.stderr)
+    server.shutdown()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+HTTP load generator: keeps `concurrency` keep-alive connections busy
+against one URL for `duration` seconds and reports throughput and
+latency percentiles as JSON.
+
+    python benchmarks/load.py http://localhost:8000/actors \
+        --concurrency 64 --duration 10 \
+        --header "Authorization: Bearer $TOKEN"
+
+Run it against each server with the same worker count to compare them,
+for instance the sync workers of the Procfile and the ASGI entry point:
+
+    gunicorn -w 4 app:app
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker asgi:application
+'''
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, statuses, errors, seconds):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 1) if seconds else 0,
+        'latency_ms': {
+            name: round(value * 1000, 2) if value is not None else None
+            for name, value in (('p50', percentile(ordered, 0.50)),
+                                ('p95', percentile(ordered, 0.95)),
+                                ('p99', percentile(ordered, 0.99)),
+                                ('max', ordered[-1] if ordered else None))
+        },
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())}
+    }
+
+
+def run(url, concurrency=16, duration=10.0, headers=None, method='GET',
+        body=None, next_request=None):
+    """Returns the summary of hammering `url` for `duration` seconds.
+    `next_request`, when given, is called before each request and
+    returns its (path, body), sent to the host of `url`.
+    """
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection \
+        if parts.scheme == 'https' else http.client.HTTPConnection
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    headers = dict(headers or {})
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        connection = connection_class(parts.netloc, timeout=30)
+        mine = []
+        counts = {}
+        failed = 0
+        while time.perf_counter() < deadline:
+            path, data = next_request() if next_request else (target, body)
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=data,
+                                   headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = connection_class(parts.netloc, timeout=30)
+                continue
+            mine.append(time.perf_counter() - started)
+            counts[response.status] = counts.get(response.status, 0) + 1
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            for status, count in counts.items():
+                statuses[status] = statuses.get(status, 0) + count
+            errors[0] += failed
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, errors[0],
+                     time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('-H', '--header', action='append', default=[],
+                        help='"Name: value", may be repeated')
+    args = parser.parse_args()
+    headers = dict(header.split(':', 1) for header in args.header)
+    headers = {name.strip(): value.strip()
+               for name, value in headers.items()}
+    print(json.dumps(run(args.url, args.concurrency, args.duration,
+                         headers), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+from flask import request, abort
+from models import bulk_insert, bulk_update, bulk_delete
+from validation import ValidationError
+from serialization import jsonify
+
+MAX_BULK_ITEMS = 10000
+# a PATCH item with nothing to change
+NO_FIELDS = 'no fields to update.'
+
+'''
+Request handling of the /<resource>/bulk endpoints.
+
+Every item is validated with the rules of the single-entity endpoints,
+the valid ones are written in one transaction and the response lists a
+result per item, in request order. With ?atomic=true nothing is written
+when any item fails validation and the response (422) lists those
+items only.
+'''
+
+
+def _get_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or len(items) > MAX_BULK_ITEMS:
+        abort(400)
+    return items
+
+
+def _is_atomic():
+    return request.args.get('atomic', '').lower() in ('1', 'true', 'yes')
+
+
+def _failed(index, message, error=400):
+    return {'index': index, 'success': False, 'error': error,
+            'message': message}
+
+
+def _get_id(item):
+    id = item.get('id') if isinstance(item, dict) else item
+    if not isinstance(id, int) or isinstance(id, bool):
+        raise ValidationError('id must be an integer.')
+    return id
+
+
+def _reject(results):
+    return jsonify({
+        'success': False,
+        'error': 422,
+        'message': 'unprocessable',
+        'results': results
+    }), 422
+
+
+def _respond(results, count_name, count):
+    results.sort(key=lambda result: result['index'])
+    return jsonify({
+        'success': True,
+        count_name: count,
+        'results': results
+    }), 200
+
+
+def _write(write, model, rows):
+    try:
+        return write(model, rows)
+    except Exception:
+        abort(422)
+
+
+def bulk_create(model, validate):
+    results = []
+    rows = []
+    indexes = []
+    for index, item in enumerate(_get_items()):
+        try:
+            rows.append(validate(item))
+            indexes.append(index)
+        except ValidationError as e:
+            results.append(_failed(index, e.message))
+
+    if results and _is_atomic():
+        return _reject(results)
+    ids = _write(bulk_insert, model, rows) if rows else []
+    for index, id in zip(indexes, ids):
+        results.append({'index': index, 'success': True, 'id': id})
+    return _respond(results, 'created', len(ids))
+
+
+def bulk_patch(model, validate):
+    results = []
+    rows = []
+    indexes = []
+    for index, item in enumerate(_get_items()):
+        try:
+            id = _get_id(item)
+            fields = validate(item, partial=True)
+            if not fields:
+                raise ValidationError(NO_FIELDS)
+            rows.append(dict(fields, id=id))
+            indexes.append(index)
+        except ValidationError as e:
+            results.append(_failed(index, e.message))
+
+    if results and _is_atomic():
+        return _reject(results)
+    updated = _write(bulk_update, model, rows) if rows else set()
+    for index, row in zip(indexes, rows):
+        if row['id'] in updated:
+            results.append(
+                {'index': index, 'success': True, 'id': row['id']})
+        else:
+            results.append(_failed(index, 'resource not found', 404))
+    return _respond(results, 'updated',
+                    sum(1 for result in results if result['success']))
+
+
+def bulk_remove(model):
+    results = []
+    ids = []
+    indexes = []
+    repeated = []
+    seen = set()
+    for index, item in enumerate(_get_items()):
+        try:
+            id = _get_id(item)
+        except ValidationError as e:
+            results.append(_failed(index, e.message))
+            continue
+        # a row is deleted once, by the first item naming it
+        if id in seen:
+            repeated.append(index)
+        else:
+            seen.add(id)
+            ids.append(id)
+            indexes.append(index)
+
+    if results and _is_atomic():
+        return _reject(results)
+    deleted = _write(bulk_delete, model, ids) if ids else set()
+    for index in repeated:
+        results.append(_failed(index, 'id listed more than once.', 409))
+    for index, id in zip(indexes, ids):
+        if id in deleted:
+            results.append({'index': index, 'success': True, 'id': id})
+        else:
+            results.append(_failed(index, 'resource not found', 404))
+    return _respond(results, 'deleted',
+                    sum(1 for result in results if result['success']))
@@ -0,0 +1,206 @@
+import os
+import zlib
+from flask import g, request
+from instrumentation import phase
+import metrics
+import response_cache
+
+'''
+Response compression
+
+init_app(app) compresses JSON, NDJSON, CSV and text responses with the
+best encoding the client accepts (Accept-Encoding): zstd when the
+`zstandard` package is installed, br when `brotli` is, gzip always.
+
+Bodies smaller than COMPRESS_MIN_SIZE bytes (default 500) are sent as
+they are, compressing them would cost more than it saves. Streamed
+responses (the exports) are compressed chunk by chunk as they are
+produced. COMPRESS_LEVEL sets the gzip level (default 6);
+COMPRESSION=false turns it all off.
+
+Responses served through @cached (response_cache.py) keep their
+compressed body in a cache of the same kind (RESPONSE_CACHE), so a hot
+page is compressed once per encoding and table version, not per
+request. It reports its own hits and misses.
+
+The ETag of a compressed response names its encoding, "<etag>-gzip",
+so caches never mix up representations; http_cache still recognizes it
+in If-None-Match.
+'''
+
+ENABLED = os.environ.get('COMPRESSION', 'true').lower() \
+    in ('1', 'true', 'yes')
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+
+MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv',
+             'text/plain', 'text/html'}
+
+# compressed bodies of @cached responses, kept apart from the response
+# cache so they neither count in its metrics nor evict its entries.
+# Their keys carry the table versions, stale ones are never read again.
+cache = response_cache.create_cache() \
+    if ENABLED and response_cache.cache is not None else None
+
+
+class _Stream:
+    """Compresses a body chunk by chunk, flushing after each one so the
+    client can decode what it received so far.
+    """
+
+    def __init__(self, compress, flush, finish):
+        self._compress = compress
+        self._flush = flush
+        self._finish = finish
+
+    def compress(self, chunk):
+        return self._compress(chunk) + self._flush()
+
+    def finish(self):
+        return self._finish()
+
+
+def _gzip():
+    # wbits=31 writes a gzip header, with no name or timestamp, so equal
+    # bodies compress to equal bytes
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, 31)
+    return _Stream(compressor.compress,
+                   lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                   compressor.flush)
+
+
+# encoding: stream factory, in order of preference
+ENCODINGS = {}
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+else:
+    def _zstd():
+        compressor = zstandard.ZstdCompressor().compressobj()
+        return _Stream(
+            compressor.compress,
+            lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush)
+    ENCODINGS['zstd'] = _zstd
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+else:
+    def _brotli():
+        compressor = brotli.Compressor(quality=5)
+        return _Stream(compressor.process, compressor.flush,
+                       compressor.finish)
+    ENCODINGS['br'] = _brotli
+
+ENCODINGS['gzip'] = _gzip
+
+
+def negotiate(accept_encodings):
+    """Returns the encoding to use for a werkzeug Accept of the client's
+    Accept-Encoding, or None. Ties go to the better compression.
+    """
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding):
+    stream = ENCODINGS[encoding]()
+    return stream.compress(data) + stream.finish()
+
+
+def _compress_stream(iterable, encoding):
+    stream = ENCODINGS[encoding]()
+    try:
+        for chunk in iterable:
+            if chunk:
+                data = stream.compress(chunk)
+                if data:
+                    yield data
+        yield stream.finish()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+def _compressed_body(response, encoding):
+    """Returns the compressed body, from the cache of compressed bodies
+    when the view is @cached.
+    """
+    entry = g.get('response_cache_entry')
+    if entry is None or cache is None or response.status_code != 200:
+        return compress(response.get_data(), encoding)
+    key, tables = entry
+    key = '{}.{}'.format(key, encoding)
+    data = cache.get(key)
+    if data is None:
+        data = compress(response.get_data(), encoding)
+        cache.set(key, data, tags=tables)
+    return data
+
+
+def _not_modified(response):
+    # keep the ETag of the representation the client has
+    etag, weak = response.get_etag()
+    encoding = negotiate(request.accept_encodings)
+    if etag and encoding and \
+            '{}-{}'.format(etag, encoding) in request.if_none_match:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
+
+
+def compress_response(response):
+    if response.status_code == 304:
+        # a 304 carries the Vary of the response it stands for
+        response.vary.add('Accept-Encoding')
+        return _not_modified(response)
+    if response.mimetype not in MIMETYPES or \
+            response.status_code < 200 or \
+            response.status_code in (204, 206) or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        if len(response.get_data()) < MIN_SIZE:
+            return response
+        with phase('compress'):
+            response.set_data(_compressed_body(response, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
+
+
+def init_app(app):
+    if ENABLED:
+        app.after_request(compress_response)
+
+
+@metrics.register
+def compression_cache_metrics():
+    if cache is None:
+        return []
+    stats = cache.stats()
+    return [
+        ('compressed_body_cache_hits_total', 'counter',
+         'Compressed bodies served from the cache.',
+         [({}, stats['hits'])]),
+        ('compressed_body_cache_misses_total', 'counter',
+         'Compressed bodies that had to be compressed.',
+         [({}, stats['misses'])])
+    ]
@@ -0,0 +1,137 @@
+import os
+import time
+import weakref
+from functools import lru_cache
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+import metrics
+
+'''
+Connection pool settings and metrics
+
+engine_options(database_path, config)
+    builds SQLALCHEMY_ENGINE_OPTIONS from app.config, falling back to
+    the environment, then to the defaults below:
+
+    DB_POOL_SIZE          connections kept open per worker (5)
+    DB_MAX_OVERFLOW       extra connections opened under load (10)
+    DB_POOL_TIMEOUT       seconds to wait for a free connection (30)
+    DB_POOL_RECYCLE       seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING      test connections before use (true)
+    DB_STATEMENT_TIMEOUT  PostgreSQL statement_timeout in ms (0, none)
+
+    Every worker owns a pool, so workers * (DB_POOL_SIZE +
+    DB_MAX_OVERFLOW) must stay below PostgreSQL max_connections.
+
+    The pool metrics are labeled with the database URL, password
+    hidden, and its role: primary, or replica (see replicas.py).
+'''
+
+CHECKOUT_WAIT = metrics.Histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the pool.',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+    labelnames=('database', 'role'))
+CHECKOUT_TIMEOUTS = metrics.Counter(
+    'db_pool_checkout_timeouts_total',
+    'Checkouts that gave up after DB_POOL_TIMEOUT seconds.',
+    labelnames=('database', 'role'))
+
+# pools are recreated on engine.dispose(), only the live ones report
+_pools = weakref.WeakSet()
+
+
+class TimedQueuePool(QueuePool):
+    # metric labels, set per database by pool_class()
+    labels = {'database': '', 'role': ''}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            CHECKOUT_TIMEOUTS.inc(**self.labels)
+            raise
+        finally:
+            CHECKOUT_WAIT.observe(time.perf_counter() - started,
+                                  **self.labels)
+
+
+@lru_cache(maxsize=None)
+def pool_class(database_path, role):
+    """Returns the TimedQueuePool of a database, its metrics are labeled
+    with the URL (password hidden) and the role, primary or replica.
+    Being a class, the labels survive engine.dispose().
+    """
+    url = make_url(database_path).render_as_string(hide_password=True)
+    return type('TimedQueuePool', (TimedQueuePool,),
+                {'labels': {'database': url, 'role': role}})
+
+
+def _setting(config, name, default, cast=int):
+    value = config.get(name, os.environ.get(name))
+    if value is None or value == '':
+        return default
+    if cast is bool:
+        return str(value).lower() in ('1', 'true', 'yes')
+    return cast(value)
+
+
+def engine_options(database_path, config, role='primary'):
+    if database_path.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': pool_class(database_path, role),
+        'pool_size': _setting(config, 'DB_POOL_SIZE', 5),
+        'max_overflow': _setting(config, 'DB_MAX_OVERFLOW', 10),
+        'pool_timeout': _setting(config, 'DB_POOL_TIMEOUT', 30, float),
+        'pool_recycle': _setting(config, 'DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': _setting(config, 'DB_POOL_PRE_PING', True, bool)
+    }
+    statement_timeout = _setting(config, 'DB_STATEMENT_TIMEOUT', 0)
+    if statement_timeout and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)
+        }
+    return options
+
+
+@metrics.register
+def pool_metrics():
+    # {labels: [size, checked out, overflow, capacity]}, a disposed pool
+    # may still be alive next to its replacement
+    pools = {}
+    for pool in list(_pools):
+        labels = tuple(sorted(pool.labels.items()))
+        totals = pools.setdefault(labels, [0, 0, 0, 0])
+        totals[0] += pool.size()
+        totals[1] += pool.checkedout()
+        totals[2] += max(pool.overflow(), 0)
+        totals[3] += pool.size() + max(pool._max_overflow, 0)
+    size = []
+    checked_out = []
+    overflow = []
+    saturation = []
+    for labels, (pool_size, in_use, extra, capacity) in pools.items():
+        labels = dict(labels)
+        size.append((labels, pool_size))
+        checked_out.append((labels, in_use))
+        overflow.append((labels, extra))
+        saturation.append(
+            (labels, round(in_use / capacity, 4) if capacity else 0))
+    return [
+        ('db_pool_size', 'gauge',
+         'Connections the pool keeps open.', size),
+        ('db_pool_checked_out', 'gauge',
+         'Connections currently in use.', checked_out),
+        ('db_pool_overflow', 'gauge',
+         'Connections open beyond DB_POOL_SIZE.', overflow),
+        ('db_pool_saturation', 'gauge',
+         'Connections in use over DB_POOL_SIZE + DB_MAX_OVERFLOW.',
+         saturation)
+    ]
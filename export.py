@@ -0,0 +1,67 @@
+import csv
+import io
+from datetime import date
+from flask import Response, abort, request, stream_with_context
+from models import db
+from serialization import dumps
+
+EXPORT_BATCH_SIZE = 1000
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+'''
+Streaming export of a whole table
+
+The rows are read through a server-side cursor, EXPORT_BATCH_SIZE at a
+time, as plain column tuples (no ORM objects, no format() dicts) and
+written to the response as they arrive, so memory stays flat however
+large the table is.
+'''
+
+
+def _ndjson_lines(names, rows):
+    buffer = []
+    for row in rows:
+        buffer.append(dumps(dict(zip(names, row))))
+        if len(buffer) == EXPORT_BATCH_SIZE:
+            yield b'\n'.join(buffer) + b'\n'
+            buffer = []
+    if buffer:
+        yield b'\n'.join(buffer) + b'\n'
+
+
+def _csv_lines(names, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([value.isoformat() if isinstance(value, date)
+                         else value for value in row])
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_response(model, filename):
+    """Streams every row of `model` as ?format=ndjson (default) or csv.
+    """
+    format = request.args.get('format', 'ndjson').lower()
+    if format not in FORMATS:
+        abort(400)
+
+    names = list(model.format_fields)
+    columns = [getattr(model, name) for name in names]
+    # started here, on the database the view was routed to
+    rows = iter(db.session.query(*columns).order_by(model.id)
+                .yield_per(EXPORT_BATCH_SIZE))
+    lines = _ndjson_lines if format == 'ndjson' else _csv_lines
+
+    response = Response(stream_with_context(lines(names, rows)),
+                        mimetype=FORMATS[format])
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={}.{}'.format(filename, format)
+    return response
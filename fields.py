@@ -0,0 +1,75 @@
+from functools import lru_cache
+from flask import abort
+from sqlalchemy.orm import Bundle
+from models import db
+
+'''
+Sparse fieldsets
+
+?fields=id,name limits every item of a response to the listed keys of
+format(). Without related data the columns are selected on their own,
+in a Bundle, so no ORM object is built for the rows; the page is
+formatted straight from the result tuples.
+'''
+
+
+def requested_fields(request, model):
+    """Returns the ?fields= of `model` in format() order, or None when
+    all of them are wanted. Aborts with 400 on an unknown field.
+    """
+    value = request.args.get('fields')
+    if not value:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    if not names or not names <= set(model.format_fields):
+        abort(400)
+    return tuple(name for name in model.format_fields if name in names)
+
+
+# one Bundle per field set, a new one would miss the SQL compile cache
+@lru_cache(maxsize=None)
+def _bundle(model, fields):
+    return Bundle(model.__tablename__,
+                  *[getattr(model, name) for name in fields])
+
+
+def format_row(row):
+    return dict(row._mapping)
+
+
+def project(query, model, fields):
+    """Returns `query` selecting only `fields`, and the formatter of its
+    rows for pagination.paginate.
+    """
+    return query.with_entities(_bundle(model, fields)), format_row
+
+
+def only(fields, formatter, *extra):
+    """Wraps a formatter of whole objects to keep `fields` (and the
+    `extra` keys, such as related lists) of its result.
+    """
+    if fields is None:
+        return formatter
+    keep = set(fields).union(extra)
+
+    def formatter_only(item):
+        return {key: value for key, value in formatter(item).items()
+                if key in keep}
+    return formatter_only
+
+
+def get_formatted(model, id, fields=None):
+    """Returns (formatted row, version) of the row of `model` with this
+    id, or None. The row holds the version too, unless `fields` leaves
+    it out.
+    """
+    if fields is None:
+        item = model.query.get(id)
+        if item is None:
+            return None
+        return dict(item.format(), version=item.version), item.version
+    row = db.session.query(_bundle(model, fields), model.version) \
+        .filter(model.id == id).first()
+    if row is None:
+        return None
+    return format_row(row[0]), row.version
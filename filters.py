@@ -0,0 +1,127 @@
+from flask import abort
+from dateutil import parser as date_parser
+from sqlalchemy import collate, func
+from models import Actor, Movie, db
+
+'''
+Server-side filtering and sorting of the list endpoints
+
+GET /actors   ?name=<prefix>&gender=M&age_min=20&age_max=40
+GET /movies   ?title=<prefix>&release_date_min=2000-01-01
+              &release_date_max=2010-12-31
+both          ?sort=-age,name  (whitelisted columns, - for descending)
+
+Every filter maps to a B-tree index (see the 5b7c0e9f2a41 migration).
+Names and titles are matched and sorted case-insensitively on
+lower(column) COLLATE "C", whose index serves both the prefix LIKE and
+the ORDER BY.
+'''
+
+
+def folded(column):
+    """lower(column), in the byte order its PostgreSQL index uses."""
+    expression = func.lower(column)
+    if db.engine.dialect.name == 'postgresql':
+        expression = collate(expression, 'C')
+    return expression
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+def _prefix(column, value):
+    return folded(column).like(_escape_like(value.lower()) + '%',
+                               escape='\\')
+
+
+def _integer(value):
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def _date(value):
+    try:
+        return date_parser.parse(value)
+    except (ValueError, OverflowError):
+        abort(400)
+
+
+def _character(value):
+    if len(value) != 1:
+        abort(400)
+    return value
+
+
+# parameter: (column, comparison, parser)
+FILTERS = {
+    Actor: {
+        'name': ('name', 'prefix', str),
+        'gender': ('gender', '==', _character),
+        'age_min': ('age', '>=', _integer),
+        'age_max': ('age', '<=', _integer)
+    },
+    Movie: {
+        'title': ('title', 'prefix', str),
+        'release_date_min': ('release_date', '>=', _date),
+        'release_date_max': ('release_date', '<=', _date)
+    }
+}
+
+# sortable fields, text columns sort on their folded form
+SORTS = {
+    Actor: {
+        'id': lambda: Actor.id,
+        'name': lambda: folded(Actor.name),
+        'age': lambda: Actor.age,
+        'gender': lambda: Actor.gender
+    },
+    Movie: {
+        'id': lambda: Movie.id,
+        'title': lambda: folded(Movie.title),
+        'release_date': lambda: Movie.release_date
+    }
+}
+
+
+def apply_filters(request, model, query):
+    for parameter, (name, comparison, parse) in FILTERS[model].items():
+        value = request.args.get(parameter)
+        if value is None or value == '':
+            continue
+        column = getattr(model, name)
+        value = parse(value)
+        if comparison == 'prefix':
+            query = query.filter(_prefix(column, value))
+        elif comparison == '==':
+            query = query.filter(column == value)
+        elif comparison == '>=':
+            query = query.filter(column >= value)
+        else:
+            query = query.filter(column <= value)
+    return query
+
+
+def sort_keys(request, model):
+    """Returns the (expression, descending) pairs of ?sort=, ending with
+    the primary key so the order is total and cursors are unambiguous.
+    """
+    keys = []
+    seen = set()
+    for field in request.args.get('sort', '').split(','):
+        field = field.strip()
+        if not field:
+            continue
+        descending = field.startswith('-')
+        field = field.lstrip('-')
+        if field not in SORTS[model] or field in seen:
+            abort(400)
+        seen.add(field)
+        keys.append((SORTS[model][field](), descending))
+        if field == 'id':
+            return keys
+    keys.append((model.id, keys[-1][1] if keys else False))
+    return keys
@@ -0,0 +1,30 @@
+'''
+gunicorn settings, read by `gunicorn app:app` from the working directory
+
+The master builds the app once (preload_app) and imports python-jose
+and the signing keys before forking, so new workers start with all of
+it in memory instead of loading it on their first request. Workers are
+then ready as soon as they fork, which matters when scaling out on a
+burst of traffic. Database connections must not be shared across
+fork(), so the master closes its pool and every worker drops the one
+it inherited.
+'''
+
+preload_app = True
+
+
+def _dispose_engines():
+    from app import app
+    from models import db
+    db.get_engine(app).dispose()
+    app.extensions['replicas'].dispose()
+
+
+def when_ready(server):
+    from auth.auth import preload
+    preload()
+    _dispose_engines()
+
+
+def post_fork(server, worker):
+    _dispose_engines()
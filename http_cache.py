@@ -0,0 +1,97 @@
+import hashlib
+import os
+from functools import wraps
+from flask import g, make_response, request
+from models import table_versions
+
+# how long a client may reuse a response without revalidating
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 0))
+
+'''
+Conditional GET support
+
+@conditional(*tables)
+    decorates a view whose response only depends on the request URL and
+    the content of `tables`. A strong ETag and Last-Modified are derived
+    from the table versions (see models.touch) *before* the view runs,
+    so a matching If-None-Match / If-Modified-Since is answered with
+    304 Not Modified without querying or serializing anything.
+
+    It goes below @requires_auth, a revalidation is still authorized.
+'''
+
+
+def table_state(*tables):
+    """Returns ((version, ...), last_modified) of the given tables,
+    read once per request.
+    """
+    cached = g.setdefault('table_versions', {})
+    missing = [name for name in tables if name not in cached]
+    if missing:
+        found = table_versions(*missing)
+        for name in missing:
+            cached[name] = found.get(name, (0, None))
+
+    versions = tuple(cached[name][0] for name in tables)
+    modified = [cached[name][1] for name in tables if cached[name][1]]
+    return versions, max(modified) if modified else None
+
+
+def compute_etag(versions):
+    key = '{} {} {}'.format(
+        request.path,
+        sorted(request.args.items(multi=True)),
+        versions)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        # compressed representations carry "<etag>-<encoding>"
+        return request.if_none_match.contains(etag) or any(
+            tag.startswith(etag + '-') for tag in request.if_none_match)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def _cache_headers(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # the responses need a token: shared caches must not keep them, nor
+    # hand one caller's copy to another
+    response.cache_control.private = True
+    response.vary.add('Authorization')
+    response.cache_control.max_age = HTTP_CACHE_MAX_AGE
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def versioned(response, version):
+    """Sends the version of a single row as the strong ETag of its
+    response, the validator PATCH and DELETE take back in If-Match.
+    """
+    etag = str(version)
+    if _not_modified(etag, None):
+        response = make_response('', 304)
+    return _cache_headers(response, etag, None)
+
+
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = table_state(*tables)
+            etag = compute_etag(versions)
+            if _not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return _cache_headers(response, etag, last_modified)
+
+        return wrapper
+    return conditional_decorator
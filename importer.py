@@ -0,0 +1,109 @@
+import csv
+import json
+import time
+from models import Actor, Movie, bulk_copy, db, touch
+from validation import ValidationError, actor_fields, movie_fields
+
+IMPORT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+FORMATS = ('ndjson', 'csv')
+
+# resource name: (model, validator, permission needed to import it)
+RESOURCES = {
+    'actors': (Actor, actor_fields, 'add:actor'),
+    'movies': (Movie, movie_fields, 'add:movie')
+}
+
+'''
+Streaming import of NDJSON or CSV files
+
+read_rows(stream, format)
+    yields (line number, row) pairs from a text stream, one at a time,
+    a row that cannot be parsed is yielded as a ValidationError
+
+import_rows(resource, rows, chunk_size, progress)
+    validates the rows with the rules of create_actor / create_movie
+    and writes the valid ones `chunk_size` at a time, each chunk in its
+    own transaction, through PostgreSQL COPY (executemany on other
+    databases). `progress` is called with the running report after
+    every chunk. Only one chunk is ever held in memory.
+'''
+
+
+def guess_format(name, default='ndjson'):
+    if name and name.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_rows(stream, format):
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, ValidationError('Invalid JSON.')
+
+
+def _report(started, imported, rejected, errors):
+    seconds = time.perf_counter() - started
+    return {
+        'imported': imported,
+        'rejected': rejected,
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(imported / seconds, 1) if seconds else 0
+    }
+
+
+def _write(model, chunk):
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            bulk_copy(model, chunk)
+        else:
+            db.session.execute(model.__table__.insert(), chunk)
+        touch(model.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def import_rows(resource, rows, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    model, validate = RESOURCES[resource][:2]
+    started = time.perf_counter()
+    imported = 0
+    rejected = 0
+    errors = []
+    chunk = []
+
+    def flush():
+        nonlocal imported
+        _write(model, chunk)
+        imported += len(chunk)
+        chunk.clear()
+        if progress is not None:
+            progress(_report(started, imported, rejected, errors))
+
+    for number, row in rows:
+        try:
+            if isinstance(row, ValidationError):
+                raise row
+            chunk.append(validate(row))
+        except ValidationError as e:
+            rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'line': number, 'message': e.message})
+            continue
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return _report(started, imported, rejected, errors)
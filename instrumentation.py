@@ -0,0 +1,111 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import metrics
+
+'''
+Per-request timings
+
+init_app(app)
+    times every request and the phases it goes through:
+
+    auth       reading and verifying the bearer token (includes jwks)
+    jwks       looking up the signing key, fetching the key set if needed
+    db         SQL statements, with their count
+    serialize  encoding the JSON body
+
+    and reports them twice: in a Server-Timing response header
+    (browsers show it in their network panel; SERVER_TIMING=false turns
+    it off) and as histograms per route on GET /metrics.
+
+phase(name)
+    context manager adding the time spent in its block to `name`.
+'''
+
+REQUEST_SECONDS = metrics.Histogram(
+    'http_request_duration_seconds',
+    'Time to handle a request, by route, method and status.',
+    labelnames=('route', 'method', 'status'))
+PHASE_SECONDS = metrics.Histogram(
+    'http_request_phase_seconds',
+    'Time a request spent in auth, jwks, db or serialize.',
+    labelnames=('route', 'phase'))
+DB_STATEMENTS = metrics.Histogram(
+    'http_request_db_statements',
+    'SQL statements run by a request.',
+    labelnames=('route',), buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+
+
+def record(name, seconds, count=1):
+    timings = g.get('request_timings') if has_request_context() else None
+    if timings is None:
+        return
+    total, calls = timings.get(name, (0.0, 0))
+    timings[name] = (total + seconds, calls + count)
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    if context is not None:
+        context._instrumentation_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context,
+                  executemany):
+    started = getattr(context, '_instrumentation_started', None)
+    if started is not None:
+        record('db', time.perf_counter() - started)
+
+
+def server_timing(timings, elapsed):
+    entries = []
+    for name, (seconds, calls) in timings.items():
+        entry = '{};dur={:.2f}'.format(name, seconds * 1000)
+        if name == 'db':
+            entry += ';desc="{} statement{}"'.format(
+                calls, '' if calls == 1 else 's')
+        entries.append(entry)
+    entries.append('total;dur={:.2f}'.format(elapsed * 1000))
+    return ', '.join(entries)
+
+
+def init_app(app):
+    enabled = os.environ.get('SERVER_TIMING', 'true').lower() \
+        in ('1', 'true', 'yes')
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.request_timings = {}
+
+    @app.after_request
+    def report_request_timings(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        timings = g.request_timings
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(elapsed, route=route, method=request.method,
+                                status=response.status_code)
+        for name, (seconds, _) in timings.items():
+            PHASE_SECONDS.observe(seconds, route=route, phase=name)
+        DB_STATEMENTS.observe(timings.get('db', (0, 0))[1], route=route)
+        if enabled:
+            response.headers['Server-Timing'] = server_timing(
+                timings, elapsed)
+        return response
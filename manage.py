@@ -1,13 +1,68 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+import sys
+from flask_script import Command, Manager
 
-from app import app
-from models import db
+from importer import RESOURCES, FORMATS, IMPORT_CHUNK_SIZE, guess_format, \
+    read_rows, import_rows
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+# Flask-Migrate and Alembic are only imported for `manage.py db ...`
+# (and for the top-level help, which lists the db command)
+MIGRATE = sys.argv[1:2] in (['db'], [], ['-?'], ['--help'])
 
-manager.add_command('db', MigrateCommand)
+
+def create_app():
+    """Builds the app when a command runs rather than on import"""
+    from app import app
+    if MIGRATE:
+        from flask_migrate import Migrate
+        from models import db
+        Migrate(app, db)
+    return app
+
+
+manager = Manager(create_app)
+
+if MIGRATE:
+    from flask_migrate import MigrateCommand
+    manager.add_command('db', MigrateCommand)
+
+
+def print_progress(report):
+    print('{imported} rows imported, {rejected} rejected, '
+          '{rows_per_second} rows/s'.format(**report), file=sys.stderr)
+
+
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=IMPORT_CHUNK_SIZE, help='rows per transaction')
+@manager.option('-f', '--format', dest='format', choices=FORMATS,
+                help='ndjson or csv, guessed from the file name if omitted')
+@manager.option('path', help='NDJSON or CSV file, - for stdin')
+@manager.option('resource', choices=list(RESOURCES))
+def import_data(resource, path, format=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Streams an NDJSON or CSV file into the actors or movies table"""
+    format = format or guess_format(path)
+    if path == '-':
+        report = import_rows(resource, read_rows(sys.stdin, format),
+                             chunk_size, progress=print_progress)
+    else:
+        with open(path, newline='', encoding='utf-8') as stream:
+            report = import_rows(resource, read_rows(stream, format),
+                                 chunk_size, progress=print_progress)
+    for error in report['errors']:
+        print('line {line}: {message}'.format(**error), file=sys.stderr)
+    print('Imported {imported} rows ({rejected} rejected) in {seconds}s, '
+          '{rows_per_second} rows/s'.format(**report))
+
+
+class RefreshStats(Command):
+    """Recounts the /stats counters from the actors and movies tables"""
+
+    def run(self):
+        import stats
+        rows = stats.refresh_stats()
+        print('Recounted {} counters'.format(len(rows)))
+
+
+manager.add_command('refresh_stats', RefreshStats())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+'''
+Process-local metrics rendered in the Prometheus text format.
+
+Every gunicorn worker keeps its own numbers, a scrape sees the worker
+that happened to answer it.
+
+register(collector)
+    adds a callable returning an iterable of
+    (name, type, help, [(labels, value), ...]) tuples, it is called on
+    every scrape so collectors can read the live state of the component
+    they describe. A sample may also be a (suffix, labels, value) tuple,
+    e.g. the `_bucket`, `_sum` and `_count` series of a histogram
+
+Counter / Histogram
+    labelled series kept in memory and registered on creation
+'''
+import threading
+
+_collectors = []
+
+
+def register(collector):
+    _collectors.append(collector)
+    return collector
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def render():
+    lines = []
+    for collector in _collectors:
+        for name, kind, description, samples in collector():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sample in samples:
+                suffix = sample[0] if len(sample) == 3 else ''
+                labels, value = sample[-2:]
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        register(self.collect)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def collect(self):
+        samples = [(dict(zip(self.labelnames, key)), value)
+                   for key, value in sorted(self._values.items())]
+        return [(self.name, 'counter', self.description, samples)]
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1, 2.5, 5, 10)
+
+    def __init__(self, name, description, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        register(self.collect)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        samples = []
+        for key, series in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, series):
+                samples.append(('_bucket', dict(labels, le=bound), count))
+            samples.append(('_bucket', dict(labels, le='+Inf'), series[-1]))
+            samples.append(('_sum', labels, round(series[-2], 6)))
+            samples.append(('_count', labels, series[-1]))
+        return [(self.name, 'histogram', self.description, samples)]
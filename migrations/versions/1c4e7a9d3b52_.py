@@ -0,0 +1,45 @@
+"""add search vectors and trigram indexes
+
+Revision ID: 1c4e7a9d3b52
+Revises: 5b7c0e9f2a41
+Create Date: 2026-10-18 22:14:05.381927
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '1c4e7a9d3b52'
+down_revision = '5b7c0e9f2a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # generated columns (PostgreSQL 12+) are kept up to date by every
+    # INSERT, UPDATE and COPY, no trigger needed
+    op.execute("ALTER TABLE actors ADD COLUMN search_vector tsvector "
+               "GENERATED ALWAYS AS (to_tsvector('simple', "
+               "coalesce(name, ''))) STORED")
+    op.execute("ALTER TABLE movies ADD COLUMN search_vector tsvector "
+               "GENERATED ALWAYS AS (to_tsvector('simple', "
+               "coalesce(title, ''))) STORED")
+    op.create_index('ix_actors_search_vector', 'actors', ['search_vector'],
+                    unique=False, postgresql_using='gin')
+    op.create_index('ix_movies_search_vector', 'movies', ['search_vector'],
+                    unique=False, postgresql_using='gin')
+    op.execute('CREATE INDEX ix_actors_name_trgm ON actors '
+               'USING gin (lower(name) gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_movies_title_trgm ON movies '
+               'USING gin (lower(title) gin_trgm_ops)')
+
+
+def downgrade():
+    # pg_trgm is left installed, other database objects may use it
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_movies_search_vector', table_name='movies')
+    op.drop_index('ix_actors_search_vector', table_name='actors')
+    op.drop_column('movies', 'search_vector')
+    op.drop_column('actors', 'search_vector')
@@ -0,0 +1,33 @@
+"""add table_versions
+
+Revision ID: 3f1a9c2d7b10
+Revises: c52ac1339148
+Create Date: 2026-10-18 20:10:41.531906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1a9c2d7b10'
+down_revision = 'c52ac1339148'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.execute(
+        "INSERT INTO table_versions (name, version, updated_at) VALUES "
+        "('actors', 1, CURRENT_TIMESTAMP), ('movies', 1, CURRENT_TIMESTAMP)")
+
+
+def downgrade():
+    op.drop_table('table_versions')
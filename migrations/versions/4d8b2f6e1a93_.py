@@ -0,0 +1,27 @@
+"""seed the table version of cast
+
+Revision ID: 4d8b2f6e1a93
+Revises: 9a6f2c8e4d17
+Create Date: 2026-10-19 09:41:07.362815
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8b2f6e1a93'
+down_revision = '9a6f2c8e4d17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # every table touch() bumps has its row before the first write
+    op.execute(
+        "INSERT INTO table_versions (name, version, updated_at) "
+        "SELECT 'cast', 1, CURRENT_TIMESTAMP WHERE NOT EXISTS "
+        "(SELECT 1 FROM table_versions WHERE name = 'cast')")
+
+
+def downgrade():
+    op.execute("DELETE FROM table_versions WHERE name = 'cast'")
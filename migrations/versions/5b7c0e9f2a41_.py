@@ -0,0 +1,37 @@
+"""add filter and sort indexes
+
+Revision ID: 5b7c0e9f2a41
+Revises: 8d2e4b6a1c35
+Create Date: 2026-10-18 21:02:37.660125
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7c0e9f2a41'
+down_revision = '8d2e4b6a1c35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_actors_age'), 'actors', ['age'], unique=False)
+    op.create_index(op.f('ix_actors_gender'), 'actors', ['gender'],
+                    unique=False)
+    op.create_index(op.f('ix_movies_release_date'), 'movies',
+                    ['release_date'], unique=False)
+    # byte ordered so the same index serves LIKE 'prefix%' and ORDER BY
+    op.create_index('ix_actors_lower_name', 'actors',
+                    [sa.text('lower(name) COLLATE "C"')], unique=False)
+    op.create_index('ix_movies_lower_title', 'movies',
+                    [sa.text('lower(title) COLLATE "C"')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movies_lower_title', table_name='movies')
+    op.drop_index('ix_actors_lower_name', table_name='actors')
+    op.drop_index(op.f('ix_movies_release_date'), table_name='movies')
+    op.drop_index(op.f('ix_actors_gender'), table_name='actors')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
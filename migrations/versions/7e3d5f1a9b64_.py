@@ -0,0 +1,90 @@
+"""add stat_counts maintained by triggers
+
+Revision ID: 7e3d5f1a9b64
+Revises: 1c4e7a9d3b52
+Create Date: 2026-10-18 23:41:52.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3d5f1a9b64'
+down_revision = '1c4e7a9d3b52'
+branch_labels = None
+depends_on = None
+
+# frozen copy of stats.BUCKETS at this revision
+BUCKETS = {
+    'actors': "('actors', ''), ('actors_by_gender', gender), "
+              "('actors_by_age', (age / 10 * 10)::text)",
+    'movies': "('movies', ''), ('movies_by_release_year', "
+              "extract(year FROM release_date)::int::text)"
+}
+
+UPSERT = '''
+    INSERT INTO stat_counts (kind, bucket, count)
+    SELECT bucket.kind, bucket.bucket, sum(changes.sign)
+    FROM ({changes}) AS changes
+    CROSS JOIN LATERAL (VALUES {buckets}) AS bucket (kind, bucket)
+    GROUP BY bucket.kind, bucket.bucket
+    HAVING sum(changes.sign) <> 0
+    ORDER BY bucket.kind, bucket.bucket
+    ON CONFLICT (kind, bucket)
+    DO UPDATE SET count = stat_counts.count + excluded.count;'''
+
+FUNCTION = '''
+CREATE OR REPLACE FUNCTION {table}_count_stats() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN{insert}
+    ELSIF TG_OP = 'DELETE' THEN{delete}
+    ELSE{update}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql'''
+
+EVENTS = (
+    ('INSERT', 'NEW TABLE AS new_rows'),
+    ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+    ('DELETE', 'OLD TABLE AS old_rows')
+)
+
+
+def upgrade():
+    op.create_table(
+        'stat_counts',
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('bucket', sa.String(), nullable=False),
+        sa.Column('count', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('kind', 'bucket')
+    )
+    for table, buckets in BUCKETS.items():
+        def upsert(changes):
+            return UPSERT.format(changes=changes, buckets=buckets)
+        op.execute(FUNCTION.format(
+            table=table,
+            insert=upsert('SELECT 1 AS sign, * FROM new_rows'),
+            delete=upsert('SELECT -1 AS sign, * FROM old_rows'),
+            update=upsert('SELECT 1 AS sign, * FROM new_rows '
+                          'UNION ALL SELECT -1 AS sign, * FROM old_rows')))
+        for event, tables in EVENTS:
+            op.execute(
+                'CREATE TRIGGER {table}_count_stats_{event} AFTER {EVENT} '
+                'ON {table} REFERENCING {tables} FOR EACH STATEMENT '
+                'EXECUTE PROCEDURE {table}_count_stats()'.format(
+                    table=table, event=event.lower(), EVENT=event,
+                    tables=tables))
+        # CREATE TRIGGER locked out writers until the migration commits,
+        # so nothing is counted twice or missed
+        op.execute(upsert('SELECT 1 AS sign, * FROM {}'.format(table)))
+
+
+def downgrade():
+    for table in BUCKETS:
+        for event, _ in EVENTS:
+            op.execute('DROP TRIGGER {table}_count_stats_{event} ON '
+                       '{table}'.format(table=table, event=event.lower()))
+        op.execute('DROP FUNCTION {}_count_stats()'.format(table))
+    op.drop_table('stat_counts')
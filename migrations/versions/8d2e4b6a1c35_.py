@@ -0,0 +1,36 @@
+"""add cast
+
+Revision ID: 8d2e4b6a1c35
+Revises: 3f1a9c2d7b10
+Create Date: 2026-10-18 20:41:09.218342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4b6a1c35'
+down_revision = '3f1a9c2d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cast',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_cast_actor_id'), 'cast', ['actor_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_cast_actor_id'), table_name='cast')
+    op.drop_table('cast')
@@ -0,0 +1,29 @@
+"""add row versions to actors and movies
+
+Revision ID: 9a6f2c8e4d17
+Revises: 7e3d5f1a9b64
+Create Date: 2026-10-19 00:12:45.118302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6f2c8e4d17'
+down_revision = '7e3d5f1a9b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a constant default, so PostgreSQL adds the column without a rewrite
+    op.add_column('actors', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+    op.add_column('movies', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
@@ -1,20 +1,40 @@
 from operator import ge
+import csv
+import io
 import os
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from db_pool import engine_options
+from replicas import ReplicaSet, RoutingSQLAlchemy, replica_urls
 
-database_path = "postgres://{}/{}".format('localhost:5432', 'capstone')
-db = SQLAlchemy()
+database_path = os.environ.get(
+    'DATABASE_URL', "postgres://{}/{}".format('localhost:5432', 'capstone'))
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database comes from DATABASE_URL and the pool is sized from
+    app.config or the environment, see db_pool.engine_options
+    read replicas come from DATABASE_REPLICA_URLS, see replicas.py
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replicas=None):
+    # SQLAlchemy 1.4 only knows the postgresql:// scheme Heroku omits
+    if database_path.startswith('postgres://'):
+        database_path = 'postgresql://' + database_path[len('postgres://'):]
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, app.config)
+    if replicas is None:
+        replicas = replica_urls(app.config)
+    app.extensions['replicas'] = ReplicaSet(
+        replicas,
+        engine_options=lambda url: engine_options(url, app.config,
+                                                  role='replica'),
+        retry_seconds=float(os.environ.get('REPLICA_RETRY_SECONDS', 10)))
     db.app = app
     db.init_app(app)
 
@@ -28,6 +48,291 @@ def db_drop_and_create_all():
     db.create_all()
 
 
+'''
+TableVersion
+    a change counter per table, bumped by touch() in the transaction of
+    every write so all workers agree on what a table looks like. HTTP
+    validators (ETag / Last-Modified) are derived from it.
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+# INSERT ... ON CONFLICT DO UPDATE, by dialect
+UPSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def touch(*names):
+    """Bumps the version of the given tables, the caller commits."""
+    table = TableVersion.__table__
+    now = datetime.utcnow()
+    # read by the response cache once the transaction commits
+    db.session.info.setdefault('touched', set()).update(names)
+    insert = UPSERTS.get(db.engine.dialect.name)
+    for name in names:
+        if insert is not None:
+            # one statement, so two first writers can't both INSERT
+            db.session.execute(
+                insert(table).values(name=name, version=1, updated_at=now)
+                .on_conflict_do_update(
+                    index_elements=[table.c.name],
+                    set_={'version': table.c.version + 1,
+                          'updated_at': now}))
+            continue
+        result = db.session.execute(
+            table.update().where(table.c.name == name)
+            .values(version=table.c.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(
+                name=name, version=1, updated_at=now))
+
+
+def table_versions(*names, bind=None):
+    """Returns {name: (version, updated_at)} for the given tables,
+    tables that were never written are missing. `bind` reads them from
+    another engine, such as a replica, outside of the session.
+    """
+    table = TableVersion.__table__
+    selection = db.select([table.c.name, table.c.version,
+                           table.c.updated_at]) \
+        .where(table.c.name.in_(names))
+    if bind is not None:
+        with bind.connect() as connection:
+            rows = connection.execute(selection).fetchall()
+    else:
+        rows = db.session.execute(selection)
+    return {row.name: (row.version, row.updated_at) for row in rows}
+
+
+'''
+StatCount
+    a row count per (kind, bucket), e.g. ('actors_by_gender', 'F'),
+    kept current by PostgreSQL triggers, see stats.py
+'''
+
+
+class StatCount(db.Model):
+    __tablename__ = 'stat_counts'
+
+    kind = db.Column(db.String, primary_key=True)
+    bucket = db.Column(db.String, primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False)
+
+
+'''
+bulk_insert(model, rows) / bulk_update(model, rows) / bulk_delete(model, ids)
+    write many rows of `model` with executemany statements, `chunk_size`
+    rows per statement, and commit them as a single transaction.
+    They return the ids that were written so callers can report
+    per-item results.
+'''
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _existing_ids(model, ids):
+    table = model.__table__
+    selection = db.select([table.c.id]).where(table.c.id.in_(ids))
+    return {row.id for row in db.session.execute(selection)}
+
+
+def bulk_insert(model, rows, chunk_size=1000):
+    table = model.__table__
+    ids = []
+    try:
+        for chunk in _chunks(rows, chunk_size):
+            if db.engine.dialect.insert_executemany_returning:
+                result = db.session.execute(
+                    table.insert().returning(table.c.id), chunk)
+                ids.extend(row.id for row in result)
+            else:
+                for row in chunk:
+                    result = db.session.execute(table.insert(), row)
+                    ids.append(result.inserted_primary_key[0])
+        touch(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def bulk_copy(model, rows):
+    """Loads rows into the table of `model` with PostgreSQL COPY, in the
+    current transaction (the caller commits). Every row must have the
+    same keys.
+    """
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        model.__tablename__, ', '.join(columns)), buffer)
+
+
+def bulk_update(model, rows, chunk_size=1000):
+    table = model.__table__
+    updated = set()
+    try:
+        for chunk in _chunks(rows, chunk_size):
+            existing = _existing_ids(model, [row['id'] for row in chunk])
+            # executemany needs the same parameters for every row
+            groups = {}
+            for row in chunk:
+                columns = tuple(sorted(k for k in row if k != 'id'))
+                # a row with nothing to set is not updated
+                if columns and row['id'] in existing:
+                    groups.setdefault(columns, []).append(row)
+            for columns, group in groups.items():
+                statement = table.update() \
+                    .where(table.c.id == db.bindparam('_id')) \
+                    .values({c: db.bindparam('_' + c) for c in columns})
+                statement = statement.values(version=table.c.version + 1)
+                db.session.execute(statement, [
+                    {'_' + k: v for k, v in row.items()} for row in group])
+                updated.update(row['id'] for row in group)
+        touch(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return updated
+
+
+def bulk_delete(model, ids, chunk_size=1000):
+    table = model.__table__
+    deleted = set()
+    try:
+        for chunk in _chunks(ids, chunk_size):
+            statement = table.delete().where(table.c.id.in_(chunk))
+            if db.engine.dialect.full_returning:
+                result = db.session.execute(statement.returning(table.c.id))
+                deleted.update(row.id for row in result)
+            else:
+                deleted.update(_existing_ids(model, chunk))
+                db.session.execute(statement)
+        touch(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return deleted
+
+
+'''
+update_row(model, id, values, versions=None) / delete_row(model, id,
+versions=None)
+    write one row of `model` with a single UPDATE ... RETURNING / DELETE
+    statement and commit. `versions` restricts the write to rows whose
+    version is one of them (see If-Match in app.py). update_row bumps
+    the version and returns the new column values, delete_row returns
+    whether a row was deleted; both return a false value when no row
+    matched.
+'''
+
+
+def _matching(model, id, versions):
+    table = model.__table__
+    condition = table.c.id == id
+    if versions is not None:
+        condition &= table.c.version.in_(versions)
+    return condition
+
+
+def update_row(model, id, values, versions=None):
+    table = model.__table__
+    condition = _matching(model, id, versions)
+    statement = table.update().where(condition) \
+        .values(dict(values, version=table.c.version + 1))
+    try:
+        if db.engine.dialect.full_returning:
+            row = db.session.execute(
+                statement.returning(*table.c)).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(
+                    db.select([table]).where(table.c.id == id)).first()
+        if row is None:
+            db.session.rollback()
+            return None
+        touch(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return dict(row._mapping)
+
+
+def delete_row(model, id, versions=None):
+    table = model.__table__
+    statement = table.delete().where(_matching(model, id, versions))
+    try:
+        if not db.session.execute(statement).rowcount:
+            db.session.rollback()
+            return False
+        # the cast rows of the deleted row went with it (ON DELETE CASCADE)
+        touch(table.name, cast.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+
+'''
+cast
+    which actors play in which movie
+
+'''
+
+cast = db.Table(
+    'cast',
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True, index=True)
+)
+
+
+def add_cast(movie_id, actor_ids):
+    """Casts the given actors in a movie, ignoring those already in
+    it, and returns the ids that were added.
+    """
+    existing = {row.actor_id for row in db.session.execute(
+        db.select([cast.c.actor_id]).where(cast.c.movie_id == movie_id))}
+    added = [id for id in dict.fromkeys(actor_ids) if id not in existing]
+    if added:
+        db.session.execute(cast.insert(), [
+            {'movie_id': movie_id, 'actor_id': id} for id in added])
+        touch(cast.name)
+    db.session.commit()
+    return added
+
+
+def remove_cast(movie_id, actor_id):
+    result = db.session.execute(cast.delete().where(
+        (cast.c.movie_id == movie_id) & (cast.c.actor_id == actor_id)))
+    if result.rowcount:
+        touch(cast.name)
+    db.session.commit()
+    return result.rowcount > 0
+
+
 '''
 Movie
 
@@ -36,10 +341,18 @@ Movie
 
 class Movie(db.Model):
     __tablename__ = 'movies'
+    # keys of format(), in order
+    format_fields = ('id', 'title', 'release_date')
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
-    release_date = db.Column(db.DateTime, nullable=False)
+    release_date = db.Column(db.DateTime, nullable=False, index=True)
+    # bumped by every update, compared with If-Match
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    actors = db.relationship('Actor', secondary=cast,
+                             back_populates='movies', order_by='Actor.id',
+                             passive_deletes=True)
 
     def __init__(self, title, release_date):
         self.title = title
@@ -47,13 +360,18 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        self.version = type(self).version + 1
+        touch(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        # the cast rows of this record go with it
+        touch(self.__tablename__, cast.name)
         db.session.commit()
 
     def format(self):
@@ -72,11 +390,19 @@ Actor
 
 class Actor(db.Model):
     __tablename__ = 'actors'
+    # keys of format(), in order
+    format_fields = ('id', 'name', 'age', 'gender')
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    age = db.Column(db.Integer, nullable=False)
-    gender = db.Column(db.CHAR, nullable=False)
+    age = db.Column(db.Integer, nullable=False, index=True)
+    gender = db.Column(db.CHAR, nullable=False, index=True)
+    # bumped by every update, compared with If-Match
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    movies = db.relationship('Movie', secondary=cast,
+                             back_populates='actors', order_by='Movie.id',
+                             passive_deletes=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -85,13 +411,18 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        self.version = type(self).version + 1
+        touch(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        # the cast rows of this record go with it
+        touch(self.__tablename__, cast.name)
         db.session.commit()
 
     def format(self):
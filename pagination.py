@@ -0,0 +1,164 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from flask import abort
+from sqlalchemy import and_, or_, tuple_
+
+RESULTS_PER_PAGE = 10
+MAX_RESULTS_PER_PAGE = 100
+
+'''
+Pagination helpers shared by the list endpoints.
+
+Pages are cut in SQL with LIMIT/OFFSET (?page=N) or, preferably, with
+opaque keyset cursors (?after=<cursor> / ?before=<cursor>) holding the
+sort key values of the last / first row, so a page never costs more
+than `limit` rows no matter how large the table is.
+'''
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor, size=1):
+    """Decodes a cursor produced by encode_cursor, aborts with 400
+    if it has been tampered with or was made for another sort order.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError, binascii.Error):
+        abort(400)
+    if not isinstance(values, list) or len(values) != size:
+        abort(400)
+    return values
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _load_value(expression, value):
+    """Returns a cursor value as the python type of its sort key, aborts
+    with 400 when it can't be one, the database would reject it.
+    """
+    try:
+        python_type = expression.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is datetime:
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            abort(400)
+    if python_type is float and isinstance(value, int):
+        value = float(value)
+    # bool is an int too
+    if not isinstance(value, python_type) or \
+            isinstance(value, bool) and python_type is not bool:
+        abort(400)
+    return value
+
+
+def _seek(keys, values, forward):
+    """WHERE clause selecting the rows after (or before) `values`."""
+    ascending = [forward != descending for _, descending in keys]
+    expressions = [expression for expression, _ in keys]
+    if all(ascending) or not any(ascending):
+        # a row value comparison can be answered from a single index
+        left, right = tuple_(*expressions), tuple_(*values)
+        return left > right if ascending[0] else left < right
+
+    clauses = []
+    for index, (expression, value) in enumerate(zip(expressions, values)):
+        equal = [e == v for e, v in zip(expressions[:index], values)]
+        step = expression > value if ascending[index] else expression < value
+        clauses.append(and_(*equal, step))
+    return or_(*clauses)
+
+
+def _order(keys, forward):
+    return [expression.asc() if forward != descending else expression.desc()
+            for expression, descending in keys]
+
+
+def _wants_total(request):
+    return request.args.get('total', '').lower() in ('1', 'true', 'yes')
+
+
+def paginate(request, query, keys, formatter=None):
+    """Returns one page of `query`.
+
+    `keys` is the sort order, a list of (expression, descending) pairs
+    whose last expression is unique (usually the primary key); a bare
+    column sorts ascending on it.
+
+    The result is a dict with the formatted `items`, the `next` and
+    `prev` cursors (None at either end) and, only when ?total=true is
+    given, the `total` row count.
+    """
+    if formatter is None:
+        def formatter(row):
+            return row.format()
+    if not isinstance(keys, (list, tuple)):
+        keys = [(keys, False)]
+
+    limit = request.args.get('limit', RESULTS_PER_PAGE, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_RESULTS_PER_PAGE)
+
+    after = request.args.get('after')
+    before = request.args.get('before')
+    if after and before:
+        abort(400)
+
+    labels = ['_key{}'.format(index) for index in range(len(keys))]
+    selection = query.add_columns(*[
+        expression.label(label)
+        for (expression, _), label in zip(keys, labels)])
+
+    if after or before:
+        values = [_load_value(expression, value) for (expression, _), value
+                  in zip(keys, decode_cursor(after or before, len(keys)))]
+        forward = bool(after)
+        rows = selection.filter(_seek(keys, values, forward)) \
+            .order_by(*_order(keys, forward)).limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if forward:
+            has_more, has_prev = more, True
+        else:
+            rows.reverse()
+            has_more, has_prev = True, more
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(400)
+        rows = selection.order_by(*_order(keys, True)) \
+            .offset((page - 1) * limit).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = page > 1
+
+    def cursor(row):
+        return encode_cursor([_dump_value(getattr(row, label))
+                              for label in labels])
+
+    result = {
+        'items': [formatter(row[0]) for row in rows],
+        'next': None,
+        'prev': None
+    }
+    if rows and has_more:
+        result['next'] = cursor(rows[-1])
+    if rows and has_prev:
+        result['prev'] = cursor(rows[0])
+    if _wants_total(request):
+        result['total'] = query.order_by(None).count()
+    return result
@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('sql.slow')
+
+'''
+Opt-in SQL profiler
+
+SQL_PROFILE=true aggregates every statement the app runs, keyed by its
+SQL text (bind parameters are placeholders, so one entry covers every
+call of a query): calls, total / max time, how many calls were slow and
+the Flask endpoints that issued it. Statements slower than
+SLOW_QUERY_MS (default 100) are logged to the `sql.slow` logger with
+their parameters and endpoint, and the parameters of the slowest call
+are kept so the statement can be explained later.
+SQL_PROFILE_MAX_STATEMENTS (default 500) bounds the entries kept, the
+cheapest ones go first.
+
+The /admin/queries routes of app.py read it:
+    GET    /admin/queries?top=20&order=total   heaviest statements
+    POST   /admin/queries/<id>/explain         EXPLAIN (ANALYZE, BUFFERS)
+    DELETE /admin/queries                      start over
+
+They need the `read:queries` permission. EXPLAIN ANALYZE runs the
+statement, so only SELECTs are analyzed, inside a transaction that is
+rolled back; other statements get a plain EXPLAIN.
+'''
+
+
+def statement_id(statement):
+    return hashlib.sha1(statement.encode('utf-8')).hexdigest()[:12]
+
+
+class QueryProfiler:
+    def __init__(self, slow_seconds=0.1, max_statements=500):
+        self.slow_seconds = slow_seconds
+        self.max_statements = max_statements
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, statement, parameters, seconds, endpoint):
+        slow = seconds >= self.slow_seconds
+        if slow:
+            logger.warning('Slow query (%.1f ms) in %s: %s -- parameters: '
+                           '%.1000r', seconds * 1000, endpoint, statement,
+                           parameters)
+        with self._lock:
+            entry = self._stats.get(statement)
+            if entry is None:
+                if len(self._stats) >= self.max_statements:
+                    cheapest = min(self._stats.values(),
+                                   key=lambda e: e['total_seconds'])
+                    del self._stats[cheapest['statement']]
+                entry = self._stats[statement] = {
+                    'id': statement_id(statement),
+                    'statement': statement,
+                    'calls': 0,
+                    'slow_calls': 0,
+                    'total_seconds': 0.0,
+                    'max_seconds': 0.0,
+                    'endpoints': {},
+                    'parameters': None
+                }
+            entry['calls'] += 1
+            entry['slow_calls'] += slow
+            entry['total_seconds'] += seconds
+            if seconds >= entry['max_seconds']:
+                entry['max_seconds'] = seconds
+                entry['parameters'] = parameters
+            entry['endpoints'][endpoint] = \
+                entry['endpoints'].get(endpoint, 0) + 1
+
+    ORDERS = {
+        'total': lambda e: e['total_seconds'],
+        'mean': lambda e: e['total_seconds'] / e['calls'],
+        'max': lambda e: e['max_seconds'],
+        'calls': lambda e: e['calls']
+    }
+
+    def top(self, count=20, order='total'):
+        """Returns the `count` heaviest statements by `order`, one of
+        total, mean, max or calls.
+        """
+        with self._lock:
+            entries = sorted(self._stats.values(), key=self.ORDERS[order],
+                             reverse=True)[:count]
+            return [{
+                'id': e['id'],
+                'statement': e['statement'],
+                'calls': e['calls'],
+                'slow_calls': e['slow_calls'],
+                'total_ms': round(e['total_seconds'] * 1000, 3),
+                'mean_ms': round(e['total_seconds'] / e['calls'] * 1000, 3),
+                'max_ms': round(e['max_seconds'] * 1000, 3),
+                'endpoints': dict(e['endpoints'])
+            } for e in entries]
+
+    def find(self, id):
+        with self._lock:
+            for entry in self._stats.values():
+                if entry['id'] == id:
+                    return entry['statement'], entry['parameters']
+        return None
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def explain(self, engine, id):
+        """Returns the plan lines of a recorded statement, None if it is
+        not (or no longer) recorded.
+        """
+        found = self.find(id)
+        if found is None:
+            return None
+        statement, parameters = found
+        if isinstance(parameters, list):
+            # executemany, one row of parameters is enough for a plan
+            parameters = parameters[0] if parameters else None
+        select = statement.lstrip().split(None, 1)[0].upper() \
+            in ('SELECT', 'WITH')
+        if engine.dialect.name == 'postgresql':
+            prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if select \
+                else 'EXPLAIN '
+        else:
+            prefix = 'EXPLAIN QUERY PLAN '
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                rows = connection.exec_driver_sql(
+                    prefix + statement, parameters or ()).fetchall()
+            finally:
+                transaction.rollback()
+        return [' '.join(str(value) for value in row) for row in rows]
+
+
+def _from_environ():
+    if os.environ.get('SQL_PROFILE', '').lower() not in ('1', 'true', 'yes'):
+        return None
+    return QueryProfiler(
+        slow_seconds=float(os.environ.get('SLOW_QUERY_MS', 100)) / 1000,
+        max_statements=int(os.environ.get('SQL_PROFILE_MAX_STATEMENTS',
+                                          500)))
+
+
+profiler = _from_environ()
+
+
+def _start(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._profiler_started = time.perf_counter()
+
+
+def _end(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_profiler_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint if has_request_context() else None
+    profiler.record(statement, parameters, time.perf_counter() - started,
+                    endpoint or '-')
+
+
+if profiler is not None:
+    event.listen(Engine, 'before_cursor_execute', _start)
+    event.listen(Engine, 'after_cursor_execute', _end)
@@ -0,0 +1,257 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+import metrics
+
+logger = logging.getLogger(__name__)
+
+'''
+Rate limits and admission control
+
+check(payload, permission)
+    called by requires_auth once the token is accepted. Every principal
+    (the `sub` of the token) gets a token bucket per permission, so one
+    integration hammering GET /actors neither starves other callers nor
+    its own writes. A request finding its bucket empty is answered 429
+    with Retry-After.
+
+    RATE_LIMIT is the limit of every route, e.g. 20/second (or minute,
+    hour, day); the bucket holds that many requests and refills over the
+    period. RATE_LIMITS overrides it per view, e.g.
+    "search_all=2/second,export_actors=10/hour,get_actors=none", and
+    those views get a bucket of their own. Both are empty by default,
+    which disables rate limiting.
+
+    The buckets live where RATE_LIMIT_STORE says:
+    local   in the process (default), RATE_LIMIT_KEYS buckets at most,
+            the least recently used one is dropped (and refilled) first
+    redis   shared by all workers, at REDIS_URL. Any Redis-compatible
+            server works. If it can't be reached, requests are let
+            through rather than failed.
+
+init_app(app)
+    caps the requests a worker serves at once to MAX_CONCURRENT_REQUESTS
+    (0, the default, for no cap). Requests over it wait up to
+    ADMISSION_TIMEOUT_MS (default 0) and are then answered 503 with
+    Retry-After, before they run a query or check out a connection.
+    Keep the cap at or below DB_POOL_SIZE + DB_MAX_OVERFLOW.
+'''
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+# views that are never shed, so monitoring sees an overloaded worker
+EXEMPT = {'status', 'get_metrics'}
+
+RATE_LIMITED = metrics.Counter(
+    'http_requests_rate_limited_total',
+    'Requests answered 429 because the caller ran out of its limit.',
+    labelnames=('route',))
+SHED = metrics.Counter(
+    'http_requests_shed_total',
+    'Requests answered 503 because the worker was at '
+    'MAX_CONCURRENT_REQUESTS.')
+
+
+def parse_limit(value):
+    """Returns (requests, period in seconds) for "N/period", or None for
+    an empty value or "none".
+    """
+    value = value.strip()
+    if not value or value == 'none':
+        return None
+    count, _, period = value.partition('/')
+    if period not in PERIODS or not count.isdigit() or int(count) < 1:
+        raise ValueError('Invalid rate limit {!r}'.format(value))
+    return int(count), PERIODS[period]
+
+
+def parse_limits(value):
+    """Returns {view: limit} for "view=N/period,...". """
+    limits = {}
+    for item in value.split(','):
+        if item.strip():
+            endpoint, _, limit = item.partition('=')
+            limits[endpoint.strip()] = parse_limit(limit)
+    return limits
+
+
+def _gcra(tat, now, count, period):
+    """One request against a token bucket of `count` requests refilled
+    over `period`, kept as its theoretical arrival time (GCRA). Returns
+    (new tat, 0) when the request fits, or (tat, seconds to wait).
+    """
+    interval = period / count
+    new_tat = max(tat, now) + interval
+    allowed_at = new_tat - period
+    if now < allowed_at:
+        return tat, allowed_at - now
+    return new_tat, 0
+
+
+class LocalLimiter:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, count, period):
+        """Takes a request from the bucket of `key`, returns 0 or the
+        seconds until it would fit.
+        """
+        with self._lock:
+            now = time.monotonic()
+            tat, wait = _gcra(self._buckets.get(key, now), now,
+                              count, period)
+            self._buckets[key] = tat
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisLimiter:
+    # a failing server lets requests through, it never fails them
+    prefix = 'capstone:ratelimit:'
+    retries = 5
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def hit(self, key, count, period):
+        from redis import WatchError
+        key = self.prefix + key
+        try:
+            with self.client.pipeline() as pipe:
+                for _ in range(self.retries):
+                    try:
+                        # retried when another worker updated the bucket
+                        # between our read and our write
+                        pipe.watch(key)
+                        now = time.time()
+                        tat, wait = _gcra(float(pipe.get(key) or now),
+                                          now, count, period)
+                        if not wait:
+                            pipe.multi()
+                            pipe.set(key, repr(tat),
+                                     px=int((tat - now) * 1000) + 1)
+                            pipe.execute()
+                        return wait
+                    except WatchError:
+                        continue
+        except Exception:
+            logger.warning('Rate limit lookup failed', exc_info=True)
+            return 0
+        # the bucket is that contended, the caller is over its limit
+        return period / count
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_limiter(kind=None):
+    kind = kind or os.environ.get('RATE_LIMIT_STORE', 'local')
+    if kind == 'redis':
+        return RedisLimiter.from_url(
+            os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    return LocalLimiter(int(os.environ.get('RATE_LIMIT_KEYS', 10000)))
+
+
+default_limit = parse_limit(os.environ.get('RATE_LIMIT', ''))
+route_limits = parse_limits(os.environ.get('RATE_LIMITS', ''))
+limiter = create_limiter()
+
+
+def check(payload, permission):
+    """Aborts with 429 when the caller of `payload` exceeded the limit
+    of the current view.
+    """
+    key = '{} {}'.format(payload.get('sub', ''), permission)
+    limit = default_limit
+    if request.endpoint in route_limits:
+        # views with a limit of their own don't share the bucket
+        limit = route_limits[request.endpoint]
+        key += ' ' + request.endpoint
+    if limit is None:
+        return
+    wait = limiter.hit(key, *limit)
+    if wait:
+        RATE_LIMITED.inc(route=request.url_rule.rule)
+        raise TooManyRequests(retry_after=math.ceil(wait))
+
+
+class Admission:
+    def __init__(self, capacity=0, timeout=0):
+        self.capacity = capacity
+        self.timeout = timeout
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(max(capacity, 1))
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.timeout:
+            acquired = self._slots.acquire(timeout=self.timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if acquired:
+            with self._lock:
+                self.in_flight += 1
+        return acquired
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+
+admission = Admission(
+    int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0)),
+    int(os.environ.get('ADMISSION_TIMEOUT_MS', 0)) / 1000)
+
+
+def init_app(app):
+    if admission.capacity <= 0:
+        return
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint in EXEMPT:
+            return
+        if not admission.acquire():
+            SHED.inc()
+            raise ServiceUnavailable(retry_after=1)
+        g.admitted = True
+
+    @app.teardown_request
+    def release_request(exception=None):
+        if g.pop('admitted', False):
+            admission.release()
+
+
+@metrics.register
+def admission_metrics():
+    if admission.capacity <= 0:
+        return []
+    return [('http_requests_in_flight', 'gauge',
+             'Requests the worker is serving, out of '
+             'MAX_CONCURRENT_REQUESTS.',
+             [({}, admission.in_flight)])]
@@ -0,0 +1,163 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+import metrics
+
+logger = logging.getLogger(__name__)
+
+'''
+Read replicas
+
+DATABASE_REPLICA_URLS (comma separated, or app.config) lists replicas of
+DATABASE_URL. Views decorated with read_replica(*tables) read from one
+of them, in round robin. Everything else, and every write, stays on the
+primary.
+
+Before a replica is used, the table_versions rows of `tables` are
+compared with the primary's (see models.touch). A replica that has not
+replayed the latest write to those tables is skipped. So a client never
+reads older data than it just wrote, whichever worker serves it. A
+replica that can't be reached is left alone for REPLICA_RETRY_SECONDS
+(default 10). When no replica qualifies, the primary serves the read.
+
+Each worker creates its own replica engines on first use, with the pool
+settings of the primary (see db_pool).
+
+@read_replica(*tables)
+    decorates a read-only view to run its queries on a replica that has
+    replayed every write to `tables`. It goes right above the view,
+    below @conditional and @cached, so 304s and cache hits never look
+    at a replica. Queries must run before the view returns: a streamed
+    response starts its query first.
+'''
+
+REPLICA_ROUTING = metrics.Counter(
+    'db_read_routing_total',
+    'Replica-eligible requests by the database that served them.',
+    labelnames=('target', 'reason'))
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from the replica the request was routed to."""
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = g.get('replica_engine') if has_app_context() else None
+        if engine is not None and not self._flushing:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaSet:
+    def __init__(self, urls, engine_options=None, retry_seconds=10):
+        self.urls = list(urls)
+        # url: create_engine() options
+        self.engine_options = engine_options or (lambda url: {})
+        self.retry_seconds = retry_seconds
+        self._engines = None
+        self._pid = None
+        self._down_until = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def engines(self):
+        # engines (and their sockets) must not be shared across fork()
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._engines = [
+                        create_engine(url, **self.engine_options(url))
+                        for url in self.urls]
+                    self._down_until = {}
+                    self._pid = os.getpid()
+        return self._engines
+
+    def candidates(self):
+        """Yields the replicas that are not marked down, starting with
+        the next one in round robin order.
+        """
+        engines = self.engines
+        if not engines:
+            return
+        start = next(self._counter)
+        now = time.monotonic()
+        for offset in range(len(engines)):
+            engine = engines[(start + offset) % len(engines)]
+            if self._down_until.get(engine, 0) <= now:
+                yield engine
+
+    def mark_down(self, engine, reason):
+        logger.warning('Replica %s %s, skipping it for %ss',
+                       engine.url.render_as_string(hide_password=True),
+                       reason, self.retry_seconds)
+        self._down_until[engine] = time.monotonic() + self.retry_seconds
+
+    def dispose(self):
+        for engine in self._engines or ():
+            engine.dispose()
+
+
+def replica_urls(config):
+    value = config.get('DATABASE_REPLICA_URLS',
+                       os.environ.get('DATABASE_REPLICA_URLS', ''))
+    if isinstance(value, str):
+        value = value.split(',')
+    urls = []
+    for url in value:
+        url = url.strip()
+        if url.startswith('postgres://'):
+            url = 'postgresql://' + url[len('postgres://'):]
+        if url:
+            urls.append(url)
+    return urls
+
+
+def _current_replica(replicas, tables):
+    # models imports this module
+    from http_cache import table_state
+    from models import table_versions
+    versions, _ = table_state(*tables)
+    reason = 'unavailable'
+    for engine in replicas.candidates():
+        try:
+            found = table_versions(*tables, bind=engine)
+        except Exception:
+            replicas.mark_down(engine, 'is unreachable')
+            continue
+        if all(found.get(name, (0, None))[0] >= version
+               for name, version in zip(tables, versions)):
+            REPLICA_ROUTING.inc(target='replica', reason='current')
+            return engine
+        reason = 'lagging'
+    REPLICA_ROUTING.inc(target='primary', reason=reason)
+    return None
+
+
+def read_replica(*tables):
+    def read_replica_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            replicas = current_app.extensions.get('replicas')
+            if replicas is None or not replicas.urls:
+                return f(*args, **kwargs)
+            g.replica_engine = _current_replica(replicas, tables)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                # whatever runs after the view, writes included, goes
+                # to the primary
+                g.pop('replica_engine', None)
+
+        return wrapper
+    return read_replica_decorator
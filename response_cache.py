@@ -0,0 +1,307 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, make_response, request
+from sqlalchemy import event
+from werkzeug.http import is_hop_by_hop_header
+import metrics
+from http_cache import table_state
+from models import db
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+'''
+Response cache of the read endpoints
+
+@cached(*tables)
+    decorates a view (below @requires_auth, it needs the token) and
+    caches its 200 responses (body and headers, but the per-request
+    ones) keyed by route, query args, permission set and the current
+    version of `tables`. A write bumps the version
+    (models.touch) so every worker stops serving the old entries at
+    once; the in-process backend also drops them as soon as the write
+    commits.
+
+Two backends are available, picked with RESPONSE_CACHE:
+    local   an LRU of RESPONSE_CACHE_SIZE entries per process (default)
+    redis   shared by all workers, at REDIS_URL, entries expire after
+            RESPONSE_CACHE_TTL seconds. Needs the `redis` package and
+            works with any Redis-compatible server.
+    none    disables the cache
+
+With SINGLE_FLIGHT=true, identical requests arriving while the first
+of them runs the view (same cache key, so same route, args, permissions
+and table versions) wait for its response instead of running the same
+queries again, see singleflight.py. This happens per worker, with or
+without a cache backend, and is off by default. Followers wait up to
+SINGLE_FLIGHT_TIMEOUT seconds (default 5) before running the view
+themselves.
+'''
+
+
+class LocalCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            self._entries[key] = (value, tuple(tags))
+            self._entries.move_to_end(key)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, (_, old_tags) = self._entries.popitem(last=False)
+                self._untag(old_key, old_tags)
+                self.evictions += 1
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._untag(key, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class RedisCache:
+    # a failing server degrades to cache misses, it never fails a request
+    # v2: entries hold the headers too
+    prefix = 'capstone:response:v2:'
+
+    def __init__(self, client, ttl=300):
+        self.client = client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_url(cls, url, ttl=300):
+        import redis
+        return cls(redis.Redis.from_url(url), ttl)
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception:
+            logger.warning('Response cache lookup failed', exc_info=True)
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, tags=()):
+        # keys carry the table versions, stale entries are never read
+        # again and simply expire
+        try:
+            self.client.set(self.prefix + key, value, ex=self.ttl)
+        except Exception:
+            logger.warning('Response cache store failed', exc_info=True)
+
+    def invalidate(self, tag):
+        pass
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+    def stats(self):
+        try:
+            evictions = self.client.info('stats').get('evicted_keys')
+        except Exception:
+            evictions = None
+        return {
+            'size': None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': evictions
+        }
+
+
+def create_cache(kind=None):
+    kind = kind or os.environ.get('RESPONSE_CACHE', 'local')
+    if kind == 'none':
+        return None
+    if kind == 'redis':
+        return RedisCache.from_url(
+            os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+            ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 300)))
+    return LocalCache(int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)))
+
+
+cache = create_cache()
+
+flight = SingleFlight() if os.environ.get(
+    'SINGLE_FLIGHT', 'false').lower() in ('1', 'true', 'yes') else None
+FLIGHT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 5))
+
+COALESCED = metrics.Counter(
+    'http_requests_coalesced_total',
+    'Read requests answered with the response of an identical request '
+    'that was already running.',
+    labelnames=('route',))
+
+
+# headers that belong to one response or connection, not to the page
+UNCACHED_HEADERS = {'content-length', 'date', 'set-cookie', 'server-timing'}
+
+
+def _pack(response):
+    """Returns the status line, the headers and the body of `response`
+    as bytes, laid out like HTTP/1.1.
+    """
+    lines = [str(response.status_code)]
+    for name, value in response.headers.items():
+        if name.lower() not in UNCACHED_HEADERS and \
+                not is_hop_by_hop_header(name):
+            lines.append('{}: {}'.format(name, value))
+    head = '\n'.join(lines) + '\n\n'
+    return head.encode('latin-1') + response.get_data()
+
+
+def _unpack(value):
+    head, body = value.split(b'\n\n', 1)
+    status, *lines = head.decode('latin-1').split('\n')
+    headers = [line.split(': ', 1) for line in lines]
+    return Response(body, status=int(status), headers=headers)
+
+
+def cache_key(token, versions):
+    key = '{} {} {} {}'.format(
+        request.path,
+        sorted(request.args.items(multi=True)),
+        sorted(token.get('permissions', [])),
+        versions)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _run(f, key, tables, token, args, kwargs):
+    """Runs the view, caching its response when it is a 200."""
+    response = make_response(f(token, *args, **kwargs))
+    if response.is_streamed:
+        return response, None
+    value = _pack(response)
+    if cache is not None and response.status_code == 200:
+        cache.set(key, value, tags=tables)
+    return response, value
+
+
+def _run_once(f, key, tables, token, args, kwargs):
+    call, leader = flight.join(key)
+    if not leader:
+        value = call.wait(FLIGHT_TIMEOUT)
+        if value is not None:
+            COALESCED.inc(route=request.url_rule.rule)
+            return _unpack(value)
+        return _run(f, key, tables, token, args, kwargs)[0]
+
+    value = None
+    try:
+        response, value = _run(f, key, tables, token, args, kwargs)
+        return response
+    finally:
+        flight.finish(key, call, value)
+
+
+def cached(*tables):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(token, *args, **kwargs):
+            if cache is None and flight is None:
+                return f(token, *args, **kwargs)
+            versions, _ = table_state(*tables)
+            key = cache_key(token, versions)
+            if cache is not None:
+                # compression.py caches the encoded bodies next to it
+                g.response_cache_entry = (key, tables)
+                value = cache.get(key)
+                if value is not None:
+                    return _unpack(value)
+
+            if flight is None:
+                return _run(f, key, tables, token, args, kwargs)[0]
+            return _run_once(f, key, tables, token, args, kwargs)
+
+        return wrapper
+    return cached_decorator
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_touched(session):
+    for table in session.info.pop('touched', ()):
+        if cache is not None:
+            cache.invalidate(table)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_touched(session):
+    session.info.pop('touched', None)
+
+
+@metrics.register
+def response_cache_metrics():
+    if cache is None:
+        return []
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    samples = [
+        ('response_cache_hits_total', 'counter',
+         'Read requests served from the response cache.',
+         [({}, stats['hits'])]),
+        ('response_cache_misses_total', 'counter',
+         'Read requests that had to run the view.',
+         [({}, stats['misses'])]),
+        ('response_cache_hit_ratio', 'gauge',
+         'Hits over lookups since the worker started.',
+         [({}, round(stats['hits'] / lookups, 4) if lookups else 0)])
+    ]
+    if stats['evictions'] is not None:
+        samples.append(('response_cache_evictions_total', 'counter',
+                        'Entries evicted to make room for new ones.',
+                        [({}, stats['evictions'])]))
+    if stats['size'] is not None:
+        samples.append(('response_cache_size', 'gauge',
+                        'Entries currently cached in this worker.',
+                        [({}, stats['size'])]))
+    return samples
@@ -0,0 +1,91 @@
+import re
+from flask import abort
+from sqlalchemy import DDL, event, func, literal_column, or_
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TSVECTOR
+from models import Actor, Movie, db
+
+'''
+Ranked search over actor names and movie titles
+
+GET /actors/search?q=  and  GET /movies/search?q=
+    match every word of q as a prefix against a tsvector column
+    (search_vector, generated from the name / title) and, for typos,
+    compare q with the text by pg_trgm word similarity. Both are
+    answered from GIN indexes. Rows are ranked by the better of
+    ts_rank and the similarity, then by id, and pages are cut on that
+    order with the usual cursors.
+
+The columns and indexes come with the 1c4e7a9d3b52 migration; tables
+made by db.create_all() get them from the DDL below. Databases other
+than PostgreSQL fall back to an unranked substring match.
+'''
+
+SEARCH_CONFIG = 'simple'
+MAX_QUERY_LENGTH = 200
+
+# searchable text column of each model
+SEARCHABLE = {
+    Actor: 'name',
+    Movie: 'title'
+}
+
+event.listen(db.Model.metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm'
+).execute_if(dialect='postgresql'))
+
+for _model, _column in SEARCHABLE.items():
+    _table = _model.__tablename__
+    for _statement in (
+            "ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('{config}', "
+            "coalesce({column}, ''))) STORED",
+            "CREATE INDEX ix_{table}_search_vector ON {table} "
+            "USING gin (search_vector)",
+            "CREATE INDEX ix_{table}_{column}_trgm ON {table} "
+            "USING gin (lower({column}) gin_trgm_ops)"):
+        event.listen(_model.__table__, 'after_create', DDL(
+            _statement.format(table=_table, column=_column,
+                              config=SEARCH_CONFIG)
+        ).execute_if(dialect='postgresql'))
+
+
+def search_terms(request):
+    """Returns ?q=, aborts with 400 when it is missing or too long."""
+    terms = request.args.get('q', '').strip()
+    if not terms or len(terms) > MAX_QUERY_LENGTH:
+        abort(400)
+    return terms
+
+
+def prefix_query(terms):
+    """to_tsquery() text matching every word of `terms` as a prefix;
+    only word characters are kept, so user input can't inject tsquery
+    operators.
+    """
+    return ' & '.join(word + ':*' for word in re.findall(r'\w+', terms))
+
+
+def search(model, terms):
+    """Returns (query, keys): the rows of `model` matching `terms` and
+    the sort keys to paginate them with, best match first.
+    """
+    text = func.lower(getattr(model, SEARCHABLE[model]))
+    terms = terms.lower()
+    if db.engine.dialect.name != 'postgresql':
+        query = model.query.filter(text.contains(terms, autoescape=True))
+        return query, [(model.id, False)]
+
+    similarity = func.word_similarity(terms, text)
+    # `text %> terms` is the form the trigram index answers
+    condition = text.op('%>')(terms)
+    rank = similarity
+    words = prefix_query(terms)
+    if words:
+        vector = literal_column(
+            model.__tablename__ + '.search_vector', TSVECTOR)
+        tsquery = func.to_tsquery(SEARCH_CONFIG, words)
+        condition = or_(vector.op('@@')(tsquery), condition)
+        rank = func.greatest(func.ts_rank(vector, tsquery), similarity)
+    # both are real, double precision survives the trip through cursors
+    rank = rank.cast(DOUBLE_PRECISION)
+    return model.query.filter(condition), [(rank, True), (model.id, False)]
@@ -0,0 +1,57 @@
+import json
+from datetime import date
+from flask import current_app, json as flask_json
+from instrumentation import phase
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used instead
+    orjson = None
+
+'''
+JSON encoding of the API responses
+
+jsonify(...) is a drop-in for flask.jsonify that encodes with orjson
+when it is installed (pip install orjson) and with the stdlib json
+module otherwise. Either way dates and datetimes are written as
+ISO 8601 strings and keys keep their insertion order.
+
+JSONEncoder does the same for anything still going through flask.json,
+create_app installs it as app.json_encoder.
+'''
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            type(value).__name__))
+
+
+def dumps(value):
+    """Encodes `value` to compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default)
+    return json.dumps(value, default=_default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class JSONEncoder(flask_json.JSONEncoder):
+    def default(self, value):
+        if isinstance(value, date):
+            return value.isoformat()
+        return super().default(value)
+
+
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() takes either args or kwargs, not both')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    with phase('serialize'):
+        body = dumps(data) + b'\n'
+    return current_app.response_class(
+        body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
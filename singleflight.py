@@ -0,0 +1,64 @@
+import threading
+
+'''
+SingleFlight
+    collapses identical concurrent work within a process: the first
+    caller of a key (the leader) does it, callers arriving while it
+    runs wait for its result instead of repeating it.
+
+        call, leader = flight.join(key)
+        if not leader:
+            value = call.wait(timeout)   # None: do the work yourself
+        else:
+            try:
+                value = ...
+            finally:
+                flight.finish(key, call, value)
+
+    The leader publishes None when it has nothing to share (it failed,
+    or its result can't be reused), followers then do the work
+    themselves. Nothing is kept once the leader finishes, see
+    response_cache.py for the cache that outlives a call.
+'''
+
+
+class Call:
+    def __init__(self):
+        self.value = None
+        self.followers = 0
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Returns the leader's value, or None when it had none or did
+        not finish within `timeout` seconds.
+        """
+        if not self._done.wait(timeout):
+            return None
+        return self.value
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Returns (call, True) to the caller that must do the work of
+        `key` and then finish() it, (call, False) to the others.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                return call, False
+            call = self._calls[key] = Call()
+            return call, True
+
+    def finish(self, key, call, value):
+        with self._lock:
+            del self._calls[key]
+        call.value = value
+        call._done.set()
+
+    def in_flight(self):
+        return len(self._calls)
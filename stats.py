@@ -0,0 +1,179 @@
+from sqlalchemy import DDL, event, extract, func
+from models import Actor, Movie, StatCount, db, touch
+
+'''
+Summary statistics of the catalogue
+
+GET /stats, /stats/actors and /stats/movies return row counts: actors
+in total, by gender and by age decade; movies in total and by release
+year. They read the stat_counts table, a few dozen rows, instead of
+scanning actors and movies.
+
+On PostgreSQL, statement level triggers on actors and movies keep
+stat_counts current in the transaction of every write, including bulk
+writes and COPY imports. Each statement aggregates its transition table
+(the rows it inserted, updated or deleted) into one upsert of the
+counters it changed, so a 10000 row import costs one extra statement,
+not 10000. The counters are locked in a fixed order to avoid deadlocks
+between concurrent writers.
+
+refresh_stats() (python manage.py refresh_stats) recounts everything
+from the tables, to run after restoring a dump or a TRUNCATE, or from
+cron as a safety net. Other databases have no triggers and count on
+every read.
+'''
+
+AGE_BUCKET = 10
+
+# table: [(kind, SQL of the bucket of a row)]
+BUCKETS = {
+    'actors': [
+        ('actors', "''"),
+        ('actors_by_gender', 'gender'),
+        ('actors_by_age', '(age / {0} * {0})::text'.format(AGE_BUCKET))
+    ],
+    'movies': [
+        ('movies', "''"),
+        ('movies_by_release_year',
+         'extract(year FROM release_date)::int::text')
+    ]
+}
+
+_UPSERT = '''
+    INSERT INTO stat_counts (kind, bucket, count)
+    SELECT bucket.kind, bucket.bucket, sum(changes.sign)
+    FROM ({changes}) AS changes
+    CROSS JOIN LATERAL (VALUES {buckets}) AS bucket (kind, bucket)
+    GROUP BY bucket.kind, bucket.bucket
+    HAVING sum(changes.sign) <> 0
+    ORDER BY bucket.kind, bucket.bucket
+    ON CONFLICT (kind, bucket)
+    DO UPDATE SET count = stat_counts.count + excluded.count;'''
+
+
+def trigger_ddl(table):
+    """Returns the statements creating the counting triggers of `table`.
+    """
+    buckets = ', '.join("('{}', {})".format(kind, expression)
+                        for kind, expression in BUCKETS[table])
+
+    def upsert(changes):
+        return _UPSERT.format(changes=changes, buckets=buckets)
+
+    function = '''
+CREATE OR REPLACE FUNCTION {table}_count_stats() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN{insert}
+    ELSIF TG_OP = 'DELETE' THEN{delete}
+    ELSE{update}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql'''.format(
+        table=table,
+        insert=upsert('SELECT 1 AS sign, * FROM new_rows'),
+        delete=upsert('SELECT -1 AS sign, * FROM old_rows'),
+        update=upsert('SELECT 1 AS sign, * FROM new_rows '
+                      'UNION ALL SELECT -1 AS sign, * FROM old_rows'))
+    # a trigger with transition tables handles a single event
+    triggers = [
+        'CREATE TRIGGER {table}_count_stats_{event} AFTER {EVENT} ON '
+        '{table} REFERENCING {tables} FOR EACH STATEMENT EXECUTE '
+        'PROCEDURE {table}_count_stats()'.format(
+            table=table, event=event.lower(), EVENT=event, tables=tables)
+        for event, tables in (
+            ('INSERT', 'NEW TABLE AS new_rows'),
+            ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+            ('DELETE', 'OLD TABLE AS old_rows'))]
+    return [function] + triggers
+
+
+for _model in (Actor, Movie):
+    for _statement in trigger_ddl(_model.__tablename__):
+        event.listen(_model.__table__, 'after_create', DDL(
+            _statement).execute_if(dialect='postgresql'))
+
+
+def _counted():
+    """Returns [(kind, bucket, count)] counted from the tables."""
+    age = (Actor.age / AGE_BUCKET) * AGE_BUCKET
+    year = extract('year', Movie.release_date)
+    queries = [
+        ('actors', db.session.query(func.count(Actor.id))),
+        ('actors_by_gender',
+         db.session.query(Actor.gender, func.count(Actor.id))
+         .group_by(Actor.gender)),
+        ('actors_by_age',
+         db.session.query(age, func.count(Actor.id)).group_by(age)),
+        ('movies', db.session.query(func.count(Movie.id))),
+        ('movies_by_release_year',
+         db.session.query(year, func.count(Movie.id)).group_by(year))
+    ]
+    rows = []
+    for kind, query in queries:
+        for row in query:
+            if len(row) == 1:
+                rows.append((kind, '', row[0]))
+            elif kind == 'actors_by_gender':
+                rows.append((kind, row[0], row[1]))
+            else:
+                rows.append((kind, str(int(row[0])), row[1]))
+    return rows
+
+
+def refresh_stats():
+    """Recounts stat_counts from the tables and returns its rows."""
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            # hold writers back so no trigger runs during the recount
+            db.session.execute(
+                db.text('LOCK TABLE actors, movies IN SHARE MODE'))
+        rows = _counted()
+        db.session.query(StatCount).delete()
+        db.session.execute(StatCount.__table__.insert(), [
+            {'kind': kind, 'bucket': bucket, 'count': count}
+            for kind, bucket, count in rows])
+        # cached /stats responses are keyed on these versions
+        touch('actors', 'movies')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return rows
+
+
+def _counts():
+    if db.engine.dialect.name != 'postgresql':
+        return _counted()
+    return db.session.query(StatCount.kind, StatCount.bucket,
+                            StatCount.count) \
+        .filter(StatCount.count > 0).all()
+
+
+def _sorted(buckets, label=str):
+    return {label(bucket): buckets[bucket]
+            for bucket in sorted(buckets, key=int)}
+
+
+def read_stats():
+    """Returns {'actors': {...}, 'movies': {...}}."""
+    counts = {}
+    for kind, bucket, count in _counts():
+        counts.setdefault(kind, {})[bucket] = count
+
+    def age_range(bucket):
+        return '{}-{}'.format(bucket, int(bucket) + AGE_BUCKET - 1)
+
+    return {
+        'actors': {
+            'total': counts.get('actors', {}).get('', 0),
+            'by_gender': dict(sorted(
+                counts.get('actors_by_gender', {}).items())),
+            'by_age': _sorted(counts.get('actors_by_age', {}), age_range)
+        },
+        'movies': {
+            'total': counts.get('movies', {}).get('', 0),
+            'by_release_year': _sorted(
+                counts.get('movies_by_release_year', {}))
+        }
+    }
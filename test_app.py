@@ -1,10 +1,34 @@
+import asyncio
+import gzip
 import os
+import sqlite3
+import subprocess
+import sys
 import unittest
+import uuid
+from unittest import mock
 import json
-from flask import Flask
+import tempfile
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from flask import Flask, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from models import db, Actor, Movie, setup_db
 from app import create_app
+from auth.jwks import JWKSKeyStore
+from auth.token_cache import VerifiedTokenCache
+import response_cache
+from response_cache import LocalCache, RedisCache, cached
+from asgi import ASGIAdapter
+from profiler import QueryProfiler
+from pagination import encode_cursor
+from rate_limit import LocalLimiter, RedisLimiter, parse_limits
+from singleflight import SingleFlight
+import compression
+from replicas import read_replica
+from models import touch
 
 
 casting_assistant = os.environ['casting_assistant']
@@ -45,6 +69,173 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_304_get_actors_if_none_match(self):
+        res = self.client().get('/actors', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers['ETag'])
+        self.assertTrue(res.cache_control.private)
+        self.assertIn('Authorization', res.vary)
+
+        res = self.client().get('/actors', headers={
+            'Authorization': "Bearer {}".format(casting_assistant),
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        actor = Actor(name="test", age=0, gender='M')
+        actor.insert()
+        res = self.client().get('/actors', headers={
+            'Authorization': "Bearer {}".format(casting_assistant),
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+
+    def test_server_timing_header(self):
+        res = self.client().get('/actors', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        self.assertEqual(res.status_code, 200)
+        timing = res.headers['Server-Timing']
+        self.assertIn('auth;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        res = self.client().get('/metrics')
+        self.assertIn(b'http_request_duration_seconds_count{method="GET",'
+                      b'route="/actors",status="200"}', res.data)
+
+    def test_get_actor(self):
+        actor = Actor(name="test", age=0, gender='M')
+        actor.insert()
+        res = self.client().get(f'/actors/{actor.id}', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['id'], actor.id)
+
+        # the version stays in the ETag
+        res = self.client().get(f'/actors/{actor.id}?fields=name', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        self.assertEqual(json.loads(res.data)['actor'], {'name': 'test'})
+        self.assertEqual(res.headers['ETag'], '"{}"'.format(actor.version))
+
+    def test_get_actors_with_cursor(self):
+        for i in range(11):
+            Actor(name="test", age=i, gender='M').insert()
+        res = self.client().get('/actors?total=true', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['next'])
+        self.assertIsNone(data['prev'])
+        self.assertTrue(data['total'] > 10)
+
+        res = self.client().get(f"/actors?after={data['next']}", headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        next_data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(next_data['prev'])
+        self.assertTrue(
+            next_data['actors'][0]['id'] > data['actors'][-1]['id'])
+
+    def test_400_sent_requesting_actors_with_bad_cursor(self):
+        res = self.client().get('/actors?after=invalid', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+        # well formed, but the id key holds a string
+        res = self.client().get(
+            '/actors?after={}'.format(encode_cursor(['1 OR 1=1'])),
+            headers={'Authorization': "Bearer {}".format(casting_assistant)})
+        self.assertEqual(res.status_code, 400)
+
+    def test_filter_and_sort_actors(self):
+        # a name of this run only, the database outlives it
+        name = 'Filtered {}'.format(uuid.uuid4().hex)
+        for age in (30, 31, 32):
+            actor = Actor(name=name, age=age, gender='F')
+            actor.insert()
+            self.addCleanup(actor.delete)
+        query = f'name={name}&gender=F&age_min=31&sort=-age&limit=1'
+        res = self.client().get(
+            f'/actors?{query}',
+            headers={'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0]['age'], 32)
+
+        res = self.client().get(
+            f"/actors?{query}&after={data['next']}",
+            headers={'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0]['age'], 31)
+        self.assertIsNone(data['next'])
+
+    def test_400_sent_sorting_actors_by_unknown_field(self):
+        res = self.client().get('/actors?sort=password', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_with_fields(self):
+        res = self.client().get('/actors?fields=id,name', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+
+        res = self.client().get('/actors?fields=salary', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movie_dates_are_iso_8601(self):
+        movie = Movie(title="Dated", release_date="2012-05-04")
+        movie.insert()
+        res = self.client().get(f'/movies/{movie.id}', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['release_date'],
+                         "2012-05-04T00:00:00")
+
+    def test_search_actors(self):
+        Actor(name="Meryl Streep", age=70, gender='F').insert()
+        res = self.client().get('/actors/search?q=strep', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0]['name'], "Meryl Streep")
+
+        res = self.client().get('/search?q=mer', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("Meryl Streep",
+                      [actor['name'] for actor in data['actors']])
+
+    def test_400_sent_searching_without_query(self):
+        res = self.client().get('/movies/search?q=', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_export_actors(self):
+        res = self.client().get('/actors/export?format=csv', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        lines = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,name,age,gender')
+
+        res = self.client().get('/actors/export', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(rows), len(lines) - 1)
+
     def test_create_actor(self):
         res = self.client().post(
             '/actors',
@@ -66,6 +257,48 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_bulk_create_actors(self):
+        res = self.client().post(
+            '/actors/bulk',
+            json=[
+                {'name': 'test', 'age': 1, 'gender': 'M'},
+                {'name': 'test'}],
+            headers={
+                'Authorization': "Bearer {}".format(executive_producer)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertTrue(data['results'][0]['success'])
+        self.assertFalse(data['results'][1]['success'])
+
+    def test_422_bulk_create_actors_atomic(self):
+        res = self.client().post(
+            '/actors/bulk?atomic=true',
+            json=[
+                {'name': 'test', 'age': 1, 'gender': 'M'},
+                {'name': 'test'}],
+            headers={
+                'Authorization': "Bearer {}".format(executive_producer)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(len(data['results']), 1)
+
+    def test_import_actors(self):
+        body = '\n'.join([
+            json.dumps({'name': 'test', 'age': 1, 'gender': 'M'}),
+            json.dumps({'name': 'test'})])
+        res = self.client().post(
+            '/import?resource=actors',
+            data=body,
+            headers={
+                'Authorization': "Bearer {}".format(executive_producer)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['line'], 2)
+
     def test_update_actor(self):
         actor = Actor(name="test", age="0", gender="F")
         actor.insert()
@@ -102,13 +335,81 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
-    def test_422_sent_deleting_non_existing_actor(self):
+    def test_404_sent_deleting_non_existing_actor(self):
         res = self.client().delete(f'/actors/1000', headers={
             'Authorization': "Bearer {}".format(executive_producer)})
         data = json.loads(res.data)
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'unprocessable')
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_400_sent_updating_actor_with_no_fields(self):
+        actor = Actor(name="test", age=0, gender='M')
+        actor.insert()
+        headers = {'Authorization': "Bearer {}".format(executive_producer)}
+        res = self.client().patch(f'/actors/{actor.id}', json={'age': 0},
+                                  headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'no fields to update.')
+        res = self.client().get(f'/actors/{actor.id}', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        self.assertEqual(json.loads(res.data)['actor']['version'],
+                         actor.version)
+
+    def test_412_sent_updating_actor_with_stale_version(self):
+        actor = Actor(name="test", age=0, gender='M')
+        actor.insert()
+        headers = {'Authorization': "Bearer {}".format(executive_producer),
+                   'If-Match': '"{}"'.format(actor.version)}
+        res = self.client().patch(f'/actors/{actor.id}',
+                                  json={'name': 'test1'}, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['version'],
+                         actor.version + 1)
+
+        # the same If-Match is now stale
+        res = self.client().patch(f'/actors/{actor.id}',
+                                  json={'name': 'test2'}, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['message'], 'precondition failed')
+        res = self.client().delete(f'/actors/{actor.id}', headers=headers)
+        self.assertEqual(res.status_code, 412)
+
+    def test_update_actor_if_match_etag_of_get(self):
+        actor = Actor(name="test", age=0, gender='M')
+        actor.insert()
+        res = self.client().get(f'/actors/{actor.id}', headers={
+            'Authorization': "Bearer {}".format(casting_assistant),
+            'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 200)
+        headers = {'Authorization': "Bearer {}".format(executive_producer),
+                   'If-Match': res.headers['ETag']}
+        res = self.client().patch(f'/actors/{actor.id}',
+                                  json={'name': 'test1'}, headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_stats_follow_writes(self):
+        headers = {'Authorization': "Bearer {}".format(casting_assistant)}
+        before = json.loads(self.client().get(
+            '/stats/actors', headers=headers).data)['actors']
+        actor = Actor(name="Counted", age=33, gender='F')
+        actor.insert()
+        after = json.loads(self.client().get(
+            '/stats/actors', headers=headers).data)['actors']
+        self.assertEqual(after['total'], before['total'] + 1)
+        self.assertEqual(after['by_gender']['F'],
+                         before['by_gender'].get('F', 0) + 1)
+        self.assertEqual(after['by_age']['30-39'],
+                         before['by_age'].get('30-39', 0) + 1)
+
+        actor.delete()
+        res = self.client().get('/stats', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors']['total'], before['total'])
+        self.assertIn('by_release_year', data['movies'])
 
     def test_get_all_movies(self):
         res = self.client().get('/movies', headers={
@@ -126,6 +427,55 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_cast_movie(self):
+        movie = Movie(title='test', release_date='12-12-1222')
+        movie.insert()
+        actor = Actor(name="test", age=0, gender='M')
+        actor.insert()
+        res = self.client().post(
+            f'/movies/{movie.id}/cast',
+            json={'actor_ids': [actor.id]},
+            headers={
+                'Authorization': "Bearer {}".format(executive_producer)})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(f'/movies/{movie.id}/actors', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], [actor.id])
+
+        res = self.client().get(f'/actors/{actor.id}/movies', headers={
+            'Authorization': "Bearer {}".format(casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual([m['id'] for m in data['movies']], [movie.id])
+
+    def test_movies_include_cast_query_count_is_constant(self):
+        for i in range(10):
+            movie = Movie(title='test', release_date='12-12-1222')
+            movie.insert()
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            counts = []
+            for limit in (1, 10):
+                del statements[:]
+                res = self.client().get(
+                    f'/movies?include=cast&limit={limit}', headers={
+                        'Authorization': "Bearer {}".format(
+                            casting_assistant)})
+                self.assertEqual(res.status_code, 200)
+                counts.append(len(statements))
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(counts[0], counts[1])
+
     def test_create_movie(self):
         res = self.client().post(
             '/movies',
@@ -146,6 +496,36 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_bulk_update_and_delete_movies(self):
+        movie = Movie(title='test', release_date='12-12-1222')
+        movie.insert()
+        res = self.client().patch(
+            '/movies/bulk',
+            json=[{'id': movie.id, 'title': 'test1'}, {'id': 100000,
+                                                       'title': 'test2'},
+                  {'id': movie.id}],
+            headers={
+                'Authorization': "Bearer {}".format(executive_producer)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        self.assertFalse(data['results'][1]['success'])
+        self.assertEqual(data['results'][1]['error'], 404)
+        # an item with nothing to change is not a success
+        self.assertEqual(data['results'][2]['error'], 400)
+        self.assertEqual(data['results'][2]['message'],
+                         'no fields to update.')
+
+        res = self.client().delete(
+            '/movies/bulk',
+            json=[movie.id, movie.id],
+            headers={
+                'Authorization': "Bearer {}".format(executive_producer)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 1)
+        self.assertEqual(data['results'][1]['error'], 409)
+
     def test_update_movie(self):
         movie = Movie(title='test', release_date='12-12-1222')
         movie.insert()
@@ -182,13 +562,13 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
-    def test_422_sent_deleting_non_existing_actor(self):
+    def test_404_sent_deleting_non_existing_movie(self):
         res = self.client().delete(f'/movies/1000', headers={
             'Authorization': "Bearer {}".format(executive_producer)})
         data = json.loads(res.data)
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'unprocessable')
+        self.assertEqual(data['message'], 'resource not found')
 
     def create_movie_with_casting_assistant_token(self):
         res = self.client().post(
@@ -236,5 +616,438 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
 
 
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    ''' Runs the JWKS cache against a local stand-in JWKS server'''
+
+    def setUp(self):
+        self.jwks = {'keys': [{'kid': 'a', 'kty': 'RSA', 'use': 'sig',
+                               'n': 'n', 'e': 'AQAB'}]}
+        self.requests = 0
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.requests += 1
+                body = json.dumps(test.jwks).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(
+            self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keys_are_fetched_once_per_ttl(self):
+        store = JWKSKeyStore(self.url, ttl=600)
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(self.requests, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        store = JWKSKeyStore(self.url, ttl=600, min_refetch_interval=0)
+        store.get_key('a')
+        self.jwks['keys'].append(dict(self.jwks['keys'][0], kid='b'))
+        self.assertEqual(store.get_key('b')['kid'], 'b')
+        self.assertEqual(self.requests, 2)
+
+        # rate limited, the set was fetched less than 600s ago
+        store.min_refetch_interval = 600
+        self.assertIsNone(store.get_key('c'))
+        self.assertIsNone(store.get_key('c'))
+        self.assertEqual(self.requests, 2)
+
+    def test_seed_from_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(self.jwks, f)
+            f.flush()
+            store = JWKSKeyStore('', seed_file=f.name)
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertIsNone(store.get_key('b'))
+        self.assertEqual(self.requests, 0)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    ''' This class represents the verified-token cache test case'''
+
+    def test_hit_until_expiry(self):
+        cache = VerifiedTokenCache(maxsize=2, leeway=30)
+        payload = {'exp': time.time() + 3600, 'permissions': []}
+        self.assertIsNone(cache.get('token'))
+        cache.put('token', payload)
+        self.assertEqual(cache.get('token'), payload)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_tokens_within_leeway_are_not_cached(self):
+        cache = VerifiedTokenCache(leeway=30)
+        cache.put('token', {'exp': time.time() + 10})
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = VerifiedTokenCache(maxsize=2)
+        for token in ('a', 'b'):
+            cache.put(token, {'sub': token})
+        cache.get('a')
+        cache.put('c', {'sub': 'c'})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'sub': 'a'})
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    ''' This class represents the response cache backends test case'''
+
+    def test_local_cache_evicts_and_invalidates(self):
+        cache = LocalCache(maxsize=2)
+        cache.set('a', b'1', tags=('actors',))
+        cache.set('b', b'2', tags=('movies',))
+        cache.set('c', b'3', tags=('actors',))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache.invalidate('actors')
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('b'), b'2')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    @unittest.skipUnless(os.environ.get('REDIS_URL'),
+                         'needs a Redis-compatible server at REDIS_URL')
+    def test_redis_cache(self):
+        cache = RedisCache.from_url(os.environ['REDIS_URL'], ttl=60)
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', b'1', tags=('actors',))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.stats()['misses'], 1)
+        cache.clear()
+
+    def test_cache_hit_keeps_the_headers(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = Flask(__name__)
+        setup_db(app, 'sqlite:///' + os.path.join(directory.name, 'c.db'))
+        calls = []
+
+        @cached('actors')
+        def actors(token):
+            calls.append(1)
+            return 'id,name\n', 200, {'Content-Type': 'text/csv',
+                                      'Link': '</actors?page=2>'}
+
+        # in place of @requires_auth
+        app.add_url_rule('/actors', 'actors',
+                         lambda: actors({'permissions': ['get:actors']}))
+        with app.app_context():
+            db.create_all()
+            self.addCleanup(db.get_engine(app).dispose)
+        with mock.patch.object(response_cache, 'cache', LocalCache()):
+            miss = app.test_client().get('/actors')
+            hit = app.test_client().get('/actors')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(hit.get_data(), miss.get_data())
+        self.assertEqual(sorted(hit.headers.items()),
+                         sorted(miss.headers.items()))
+
+
+class RateLimitTestCase(unittest.TestCase):
+    ''' This class represents the rate limiter test case'''
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits('get_actors=20/second, search_all='
+                                      'none,export_movies=5/hour'),
+                         {'get_actors': (20, 1), 'search_all': None,
+                          'export_movies': (5, 3600)})
+        with self.assertRaises(ValueError):
+            parse_limits('get_actors=20/fortnight')
+
+    def test_local_limiter_refills_over_the_period(self):
+        limiter = LocalLimiter()
+        self.assertEqual([limiter.hit('a', 2, 1) for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.hit('a', 2, 1), 0.5, places=1)
+        # other principals have their own bucket
+        self.assertEqual(limiter.hit('b', 2, 1), 0)
+        time.sleep(0.5)
+        self.assertEqual(limiter.hit('a', 2, 1), 0)
+
+    @unittest.skipUnless(os.environ.get('REDIS_URL'),
+                         'needs a Redis-compatible server at REDIS_URL')
+    def test_redis_limiter(self):
+        limiter = RedisLimiter.from_url(os.environ['REDIS_URL'])
+        limiter.clear()
+        self.assertEqual([limiter.hit('a', 2, 60) for _ in range(2)],
+                         [0, 0])
+        self.assertGreater(limiter.hit('a', 2, 60), 29)
+        limiter.clear()
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    ''' This class represents the request coalescing test case'''
+
+    def test_followers_share_the_leaders_value(self):
+        flight = SingleFlight()
+        runs = []
+        results = []
+        started = threading.Event()
+
+        def request():
+            call, leader = flight.join('key')
+            if not leader:
+                results.append(call.wait(5))
+                return
+            started.set()
+            time.sleep(0.2)
+            runs.append(1)
+            flight.finish('key', call, b'page')
+            results.append(b'page')
+
+        threads = [threading.Thread(target=request)]
+        threads[0].start()
+        started.wait(5)
+        threads += [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(results, [b'page'] * 5)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_followers_get_none_when_the_leader_failed(self):
+        flight = SingleFlight()
+        call, leader = flight.join('key')
+        self.assertTrue(leader)
+        other, leader = flight.join('key')
+        self.assertFalse(leader)
+        flight.finish('key', call, None)
+        self.assertIsNone(other.wait(1))
+        self.assertTrue(flight.join('key')[1])
+
+
+class CompressionTestCase(unittest.TestCase):
+    ''' This class represents the response compression test case'''
+
+    def setUp(self):
+        app = Flask(__name__)
+
+        @app.route('/big')
+        def big():
+            return {'items': list(range(1000))}
+
+        @app.route('/small')
+        def small():
+            return {'items': []}
+
+        @app.route('/stream')
+        def stream():
+            return app.response_class(
+                (b'{"id": %d}\n' % i for i in range(1000)),
+                mimetype='application/x-ndjson')
+        compression.init_app(app)
+        self.client = app.test_client()
+
+    def test_compresses_large_bodies_for_clients_that_accept_it(self):
+        res = self.client.get('/big', headers={
+            'Accept-Encoding': 'deflate, gzip;q=0.8'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(res.data)),
+                         {'items': list(range(1000))})
+
+        res = self.client.get('/big')
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_compresses_streamed_bodies(self):
+        res = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data).count(b'\n'), 1000)
+
+    def test_compressed_bodies_stay_out_of_the_response_cache(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = Flask(__name__)
+        setup_db(app, 'sqlite:///' + os.path.join(directory.name, 'c.db'))
+
+        @cached('actors')
+        def actors(token):
+            return {'items': list(range(1000))}
+
+        # in place of @requires_auth
+        app.add_url_rule('/actors', 'actors',
+                         lambda: actors({'permissions': ['get:actors']}))
+        compression.init_app(app)
+        with app.app_context():
+            db.create_all()
+            self.addCleanup(db.get_engine(app).dispose)
+        plain, compressed = LocalCache(), LocalCache()
+        with mock.patch.object(response_cache, 'cache', plain), \
+                mock.patch.object(compression, 'cache', compressed):
+            for _ in range(2):
+                res = app.test_client().get(
+                    '/actors', headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual((plain.hits, plain.misses), (1, 1))
+        self.assertEqual((compressed.hits, compressed.misses), (1, 1))
+
+    def test_not_modified_varies_on_accept_encoding(self):
+        app = Flask(__name__)
+
+        @app.route('/revalidated')
+        def revalidated():
+            return app.response_class(status=304)
+        compression.init_app(app)
+        res = app.test_client().get('/revalidated', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': '"1-gzip"'})
+        self.assertEqual(res.status_code, 304)
+        self.assertIn('Accept-Encoding', res.vary)
+
+
+class ASGIAdapterTestCase(unittest.TestCase):
+    ''' This class represents the ASGI entry point test case'''
+
+    def setUp(self):
+        wsgi_app = Flask(__name__)
+
+        @wsgi_app.route('/echo', methods=['POST'])
+        def echo():
+            from flask import request
+            return request.get_data() + request.args['suffix'].encode()
+        self.application = ASGIAdapter(wsgi_app, threads=2)
+
+    def call(self, chunks):
+        messages = [{'type': 'http.request', 'body': chunk,
+                     'more_body': index < len(chunks) - 1}
+                    for index, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/echo',
+                 'query_string': b'suffix=!', 'headers': [],
+                 'http_version': '1.1'}
+        asyncio.run(self.application(scope, receive, send))
+        return sent
+
+    def test_streamed_body_reaches_the_view(self):
+        sent = self.call([b'a', b'b', b'c'])
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(b''.join(message.get('body', b'')
+                                  for message in sent[1:]), b'abc!')
+        self.assertFalse(sent[-1].get('more_body', False))
+
+
+class QueryProfilerTestCase(unittest.TestCase):
+    ''' This class represents the SQL profiler test case'''
+
+    def test_top_statements_by_total_time(self):
+        profiler = QueryProfiler(slow_seconds=0.5, max_statements=2)
+        profiler.record('SELECT 1', (), 0.1, 'get_actors')
+        profiler.record('SELECT 1', (), 0.6, 'get_movies')
+        profiler.record('SELECT 2', (), 0.3, 'get_actors')
+        top = profiler.top(1)
+        self.assertEqual(top[0]['statement'], 'SELECT 1')
+        self.assertEqual(top[0]['calls'], 2)
+        self.assertEqual(top[0]['slow_calls'], 1)
+        self.assertEqual(top[0]['endpoints'],
+                         {'get_actors': 1, 'get_movies': 1})
+
+        # the cheapest statement makes room for a new one
+        profiler.record('SELECT 3', (), 0.01, '-')
+        self.assertEqual([e['statement'] for e in profiler.top(order='max')],
+                         ['SELECT 1', 'SELECT 3'])
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    ''' This class represents the read replica routing test case'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        primary = 'sqlite:///' + os.path.join(self.directory.name, 'p.db')
+        self.replica = os.path.join(self.directory.name, 'r.db')
+        self.app = Flask(__name__)
+        setup_db(self.app, primary, replicas=['sqlite:///' + self.replica])
+
+        @self.app.route('/actors')
+        @read_replica('actors')
+        def names():
+            return ','.join(actor.name for actor in Actor.query)
+
+        with self.app.app_context():
+            db.create_all()
+            db.session.add(Actor('primary', 30, 'F'))
+            touch('actors')
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.app.extensions['replicas'].dispose()
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        self.directory.cleanup()
+
+    def copy_to_replica(self, name):
+        with self.app.app_context():
+            source = db.get_engine(self.app).raw_connection()
+            target = sqlite3.connect(self.replica)
+            source.connection.backup(target)
+            target.execute("UPDATE actors SET name = ?", (name,))
+            target.commit()
+            target.close()
+            source.close()
+
+    def test_reads_go_to_a_current_replica(self):
+        self.copy_to_replica('replica')
+        res = self.app.test_client().get('/actors')
+        self.assertEqual(res.data, b'replica')
+
+    def test_replica_is_only_used_by_the_view(self):
+        self.copy_to_replica('replica')
+        engines = []
+        self.app.after_request(lambda response: engines.append(
+            g.get('replica_engine')) or response)
+        res = self.app.test_client().get('/actors')
+        self.assertEqual(res.data, b'replica')
+        self.assertEqual(engines, [None])
+
+    def test_lagging_replica_is_skipped(self):
+        self.copy_to_replica('replica')
+        with self.app.app_context():
+            Actor('second', 40, 'M').insert()
+        res = self.app.test_client().get('/actors')
+        self.assertEqual(res.data, b'primary,second')
+
+
+class StartupTestCase(unittest.TestCase):
+    ''' This class represents the cold start test case'''
+
+    def test_import_defers_heavy_modules_and_auth_settings(self):
+        env = {name: value for name, value in os.environ.items()
+               if name not in ('AUTH0_DOMAIN', 'ALGORITHMS',
+                               'API_AUDIENCE', 'FLASK_RUN_FROM_CLI')}
+        code = ('import sys, app; app.create_app(); '
+                'print(sorted({"jose", "flask_migrate", "alembic"} '
+                '& set(sys.modules)))')
+        output = subprocess.run(
+            [sys.executable, '-c', code], env=env, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+
 if __name__ == "__main__":
     unittest.main()
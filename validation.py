@@ -0,0 +1,71 @@
+from datetime import datetime
+from dateutil import parser as date_parser
+
+'''
+Validation of actor and movie payloads
+
+actor_fields(data) / movie_fields(data)
+    check a request body against the rules of create_actor and
+    create_movie and return the column values to write, raising
+    ValidationError otherwise. With partial=True only the given fields
+    are checked, as for PATCH.
+'''
+
+
+class ValidationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def _require_object(data):
+    if not isinstance(data, dict):
+        raise ValidationError('Expected a JSON object.')
+
+
+def actor_fields(data, partial=False):
+    _require_object(data)
+    name = data.get('name')
+    age = data.get('age')
+    gender = data.get('gender')
+    if not partial and not(name and age and gender):
+        raise ValidationError('name, age and gender are required.')
+
+    fields = {}
+    if name:
+        if not isinstance(name, str):
+            raise ValidationError('name must be a string.')
+        fields['name'] = name
+    if age:
+        try:
+            fields['age'] = int(age)
+        except (TypeError, ValueError):
+            raise ValidationError('age must be an integer.')
+    if gender:
+        if not isinstance(gender, str) or len(gender) != 1:
+            raise ValidationError('gender must be a single character.')
+        fields['gender'] = gender
+    return fields
+
+
+def movie_fields(data, partial=False):
+    _require_object(data)
+    title = data.get('title')
+    release_date = data.get('release_date')
+    if not partial and not(title and release_date):
+        raise ValidationError('title and release_date are required.')
+
+    fields = {}
+    if title:
+        if not isinstance(title, str):
+            raise ValidationError('title must be a string.')
+        fields['title'] = title
+    if release_date:
+        if isinstance(release_date, datetime):
+            fields['release_date'] = release_date
+        else:
+            try:
+                fields['release_date'] = date_parser.parse(release_date)
+            except (TypeError, ValueError, OverflowError):
+                raise ValidationError('release_date must be a date.')
+    return fields